@@ -3,7 +3,7 @@
 
 import copy, os, shutil, sys
 
-from PySide6.QtCore import Qt
+from PySide6.QtCore import Qt, QThread
 from PySide6.QtGui import QTransform
 from PySide6.QtWidgets import QApplication, QMainWindow, QMessageBox
 
@@ -14,7 +14,6 @@ from ui.ui_gui import Ui_MainWindow
 from config import read_config_file
 from context import Context
 from controller.controller import Controller
-from util import items
 
 class Arris(QMainWindow,Ui_MainWindow,Base_MainWindow):
     """The main window of the application."""
@@ -61,7 +60,8 @@ class Arris(QMainWindow,Ui_MainWindow,Base_MainWindow):
         # Disable the save button.
         self.actionSave.setEnabled(False)
 
-        for item in items(self.files_listWidget):
+        for idx in self.edited_items:
+            item = self.list_items[idx]
             # Disable bolding on edited files.
             font = item.font()
             font.setBold(False)
@@ -69,6 +69,7 @@ class Arris(QMainWindow,Ui_MainWindow,Base_MainWindow):
 
             # Disable rotation.
             item.setData(self.OFFSET_ROTATE, 0)
+        self.edited_items = set()
 
     def enter_initial(self):
         """Handles the event that the action state changes to 'initial'."""
@@ -116,8 +117,23 @@ class Arris(QMainWindow,Ui_MainWindow,Base_MainWindow):
 
         path = self.model.filePath(index)
         recursive = self.recursive_load_checkBox.isChecked()
+
+        # The number of files is not known in advance. A recursive listing
+        # can take long, so it can be cancelled.
+        self.setup_progress_bar(None, cancellable=recursive)
+
         self.context.request_directory_change.emit(path, recursive)
 
+    def on_search(self):
+        """Handles the event that the user submits a search query."""
+
+        query = self.search_lineEdit.text()
+        if len(query.strip()) == 0: return
+
+        # Request the matching files (will eventually call
+        # self.populate_listWidget).
+        self.context.request_search.emit(query)
+
     def on_selection_changed(self):
         """Handles the event that the selection in the list widget changes."""
 
@@ -125,15 +141,21 @@ class Arris(QMainWindow,Ui_MainWindow,Base_MainWindow):
 
         # Set up the progress bar to display metadata loading progress (not
         # thumbnails).
-        self.setup_progress_bar(len(files_idx))
+        self.setup_progress_bar(len(files_idx), cancellable=True)
 
         # Request selection change (will eventually call
-        # self.populate_metadata).
+        # self.populate_metadata). The edits of the previous selection are
+        # submitted first.
+        self.submit_metadata()
         self.context.request_selected_changed.emit(files_idx)
 
         # Load thumbnails.
         self.load_thumbnails(selected)
 
+        # Prefetch the neighbors when stepping through the files one by one.
+        if len(selected) == 1:
+            self.prefetch_neighbors(selected[0])
+
     def on_event_edit(self):
         """Handles the event that files are edited."""
 
@@ -144,6 +166,7 @@ class Arris(QMainWindow,Ui_MainWindow,Base_MainWindow):
             font = item.font()
             font.setBold(True)
             item.setFont(font)
+        self.edited_items.update(files_idx)
 
         # We signal that all selected entries have been edited.
         self.context.event_edit.emit(files_idx)
@@ -165,6 +188,34 @@ class Arris(QMainWindow,Ui_MainWindow,Base_MainWindow):
 
         self.context.answer_received.emit(discard)
 
+    def report_save_failure(self, errors):
+        """Informs the user about the files that could not be saved."""
+
+        self.finish_progress()
+
+        msg_box = QMessageBox(self)
+        msg_box.setWindowTitle("Saving Failed")
+        msg_box.setText(f"{len(errors)} file(s) could not be saved. Their edits have been kept, so saving can be attempted again.")
+        msg_box.setDetailedText("\n\n".join(f"{file_name}: {message}" for file_name, message in errors))
+        msg_box.setIcon(QMessageBox.Warning)
+        msg_box.setStandardButtons(QMessageBox.Ok)
+
+        msg_box.exec()
+
+    def report_listing_failure(self, path, message):
+        """Informs the user that the given directory could not be listed."""
+
+        self.finish_progress()
+
+        msg_box = QMessageBox(self)
+        msg_box.setWindowTitle("Opening Failed")
+        msg_box.setText(f"The directory '{path}' could not be listed.")
+        msg_box.setDetailedText(message)
+        msg_box.setIcon(QMessageBox.Warning)
+        msg_box.setStandardButtons(QMessageBox.Ok)
+
+        msg_box.exec()
+
     def on_rename(self):
         """Handles the event that the user wants to rename the selected
         images."""
@@ -172,6 +223,7 @@ class Arris(QMainWindow,Ui_MainWindow,Base_MainWindow):
         # We simply pass the selected images to the controller as we cannot
         # directly access the rename information.
         _, files_idx = self.get_selected_idx()
+        self.submit_metadata()
         self.context.request_rename.emit(files_idx)
 
         # We signal that all selected entries have been renamed.
@@ -187,8 +239,10 @@ class Arris(QMainWindow,Ui_MainWindow,Base_MainWindow):
         # Make deleted items unselectable and greyed out.
         for item in selected:
             item.setFlags(item.flags() & ~Qt.ItemIsSelectable & ~Qt.ItemIsEnabled)
+        self.deleted_items.update(files_idx)
 
         # Request selection change to empty.
+        self.submit_metadata()
         self.context.request_selected_changed.emit([])
 
         # Enable the undelete button.
@@ -203,16 +257,12 @@ class Arris(QMainWindow,Ui_MainWindow,Base_MainWindow):
 
         self.undelete_button.setEnabled(False)
 
-        def is_enabled(item):
-            return item.flags() & Qt.ItemIsEnabled == Qt.ItemIsEnabled
-
-        # Enable the deleted list items again and collect the indices of
-        # deleted files.
-        files_idx = []
-        for item in items(self.files_listWidget):
-            if not is_enabled(item):
-                files_idx.append(item.data(self.OFFSET_IDX))
-                item.setFlags(item.flags() | Qt.ItemIsSelectable | Qt.ItemIsEnabled)
+        # Enable the deleted list items again.
+        files_idx = sorted(self.deleted_items)
+        for idx in files_idx:
+            item = self.list_items[idx]
+            item.setFlags(item.flags() | Qt.ItemIsSelectable | Qt.ItemIsEnabled)
+        self.deleted_items = set()
 
         self.context.request_undelete.emit(files_idx)
 
@@ -241,11 +291,18 @@ class Arris(QMainWindow,Ui_MainWindow,Base_MainWindow):
     def on_save(self):
         """Handle the event that the user clicked the save button."""
 
-        total_images = self.files_listWidget.count()
-        self.setup_progress_bar(total_images)
+        # The controller sets the maximum when it knows how many files are
+        # written.
+        self.setup_progress_bar(None, cancellable=True)
 
+        self.submit_metadata()
         self.context.request_save.emit(self.optimize_checkBox.isChecked())
 
+    def on_cancel(self):
+        """Handle the event that the user clicked the cancel button."""
+
+        self.context.request_cancel.emit()
+
 if __name__ == "__main__":
     if len(sys.argv) > 1:
         default_path = sys.argv[1]
@@ -262,7 +319,22 @@ if __name__ == "__main__":
     context = Context()
     window = Arris(config, context, default_path=default_path)
     controller = Controller(config, context)
-    controller.app = window
+
+    # Run the controller in its own thread so that long operations do not
+    # block the UI.
+    controller_thread = QThread()
+    controller.moveToThread(controller_thread)
+    controller_thread.start()
+
+    def stop_controller():
+        context.request_cancel.emit()
+        controller_thread.quit()
+        controller_thread.wait()
+        controller.close()
+        # Do not decode the remaining thumbnails.
+        window.thumbnail_pool.clear()
+
+    app.aboutToQuit.connect(stop_controller)
 
     window.show()
     sys.exit(app.exec())
@@ -0,0 +1,209 @@
+import json, os, sqlite3, threading
+from datetime import datetime
+
+from picture_metadata import file_stat, get_empty_picture_data
+
+def serialize_picture_data(metadata):
+    """Converts picture data to a JSON string."""
+
+    d = dict(metadata)
+    if d["date_time"] is not None:
+        d["date_time"] = d["date_time"].isoformat()
+
+    return json.dumps(d)
+
+def deserialize_picture_data(s):
+    """Converts a JSON string created by serialize_picture_data back to picture
+    data."""
+
+    metadata = get_empty_picture_data()
+    metadata.update(json.loads(s))
+    if metadata["date_time"] is not None:
+        metadata["date_time"] = datetime.fromisoformat(metadata["date_time"])
+
+    return metadata
+
+class Catalog:
+    """A persistent on-disk catalog of the picture metadata and EXIF tags read
+    from files. The entries are keyed by file path, and an entry is valid only
+    if the size and modification time of the file and of its XMP sidecar (or
+    the absence of the sidecar) have not changed since the entry was stored.
+    Files with extensions in sidecar_extensions have sidecars. The catalog
+    also keeps a snapshot of the directory listings for walking directory
+    trees (see util.walk_files). The catalog can be used from multiple
+    threads."""
+
+    # The metadata entries that are indexed for full-text search.
+    SEARCH_ENTRIES = ["title", "description", "tags", "city", "country", "author"]
+
+    def __init__(self, file_name, sidecar_extensions=None):
+        self.file_name = os.path.expanduser(file_name)
+        self.sidecar_extensions = sidecar_extensions if sidecar_extensions is not None else []
+        os.makedirs(os.path.dirname(self.file_name), exist_ok=True)
+
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(self.file_name, check_same_thread=False)
+        with self.lock, self.connection:
+            # The entries of catalogs created before the sidecars were part of
+            # the validity check cannot be validated, so they are dropped.
+            columns = [row[1] for row in self.connection.execute("PRAGMA table_info(pictures)")]
+            if len(columns) > 0 and "sidecar_mtime" not in columns:
+                self.connection.execute("DROP TABLE pictures")
+                self.connection.execute("DROP TABLE IF EXISTS pictures_fts")
+
+            # The sidecar columns are NULL for files without a sidecar.
+            self.connection.execute("""
+                CREATE TABLE IF NOT EXISTS pictures (
+                    path          TEXT PRIMARY KEY,
+                    size          INTEGER NOT NULL,
+                    mtime         INTEGER NOT NULL,
+                    sidecar_size  INTEGER,
+                    sidecar_mtime INTEGER,
+                    metadata      TEXT NOT NULL,
+                    exif          TEXT NOT NULL
+                )
+            """)
+            self.connection.execute("""
+                CREATE TABLE IF NOT EXISTS directories (
+                    path     TEXT PRIMARY KEY,
+                    mtime    INTEGER NOT NULL,
+                    entries  TEXT NOT NULL
+                )
+            """)
+
+            # Set up the full-text search index. This is not possible if
+            # SQLite is compiled without FTS5 support.
+            exists = self.connection.execute("SELECT 1 FROM sqlite_master WHERE name = 'pictures_fts'").fetchone() is not None
+            try:
+                # The rows of the index share the row ids of the pictures table.
+                self.connection.execute(f"CREATE VIRTUAL TABLE IF NOT EXISTS pictures_fts USING fts5({', '.join(self.SEARCH_ENTRIES)})")
+                self.has_search = True
+            except sqlite3.OperationalError:
+                self.has_search = False
+
+            # Index the existing entries if the index is new.
+            if self.has_search and not exists:
+                rows = self.connection.execute("SELECT rowid, metadata FROM pictures").fetchall()
+                for rowid, metadata in rows:
+                    self._index(rowid, deserialize_picture_data(metadata))
+
+    def _index(self, rowid, metadata):
+        """Adds the given metadata to the full-text search index with the given
+        row id. Must be called with the lock held."""
+
+        row = [rowid]
+        for entry in self.SEARCH_ENTRIES:
+            value = metadata[entry]
+            if entry == "tags" and value is not None:
+                value = ", ".join(value)
+            row.append(value)
+
+        self.connection.execute(f"INSERT INTO pictures_fts (rowid, {', '.join(self.SEARCH_ENTRIES)}) VALUES (?, {', '.join('?' for _ in self.SEARCH_ENTRIES)})", row)
+
+    def _unindex(self, file_name):
+        """Removes the given file from the full-text search index. Must be
+        called with the lock held."""
+
+        row = self.connection.execute("SELECT rowid FROM pictures WHERE path = ?", (file_name,)).fetchone()
+        if row is not None:
+            self.connection.execute("DELETE FROM pictures_fts WHERE rowid = ?", row)
+
+    def get(self, file_names):
+        """Returns the valid catalog entries for the given files as a
+        dictionary with the file names as keys and pairs (metadata, EXIF tags)
+        as values. Files without a valid entry are not included."""
+
+        result = {}
+        with self.lock:
+            for file_name in file_names:
+                row = self.connection.execute("SELECT size, mtime, sidecar_size, sidecar_mtime, metadata, exif FROM pictures WHERE path = ?", (file_name,)).fetchone()
+                if row is None: continue
+                if file_stat(file_name, self.sidecar_extensions) != row[:4]: continue
+                result[file_name] = (deserialize_picture_data(row[4]), json.loads(row[5]))
+
+        return result
+
+    def put(self, entries):
+        """Stores the given entries in the catalog. The entries are given as a
+        dictionary with the file names as keys and pairs (metadata, EXIF tags)
+        as values. The current size and modification time of the files and
+        their sidecars are stored with the entries."""
+
+        rows = []
+        for file_name, (metadata, exif) in entries.items():
+            st = file_stat(file_name, self.sidecar_extensions)
+            if st is None: continue
+            rows.append((file_name, *st, serialize_picture_data(metadata), json.dumps(exif)))
+
+        with self.lock, self.connection:
+            if not self.has_search:
+                self.connection.executemany("INSERT OR REPLACE INTO pictures VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+                return
+
+            # Replacing a row changes its row id, so the index row is replaced
+            # as well.
+            for row in rows:
+                self._unindex(row[0])
+                rowid = self.connection.execute("INSERT OR REPLACE INTO pictures VALUES (?, ?, ?, ?, ?, ?, ?)", row).lastrowid
+                self._index(rowid, entries[row[0]][0])
+
+    def remove(self, file_names):
+        """Removes the entries of the given files from the catalog."""
+
+        with self.lock, self.connection:
+            for file_name in file_names:
+                if self.has_search:
+                    self._unindex(file_name)
+                self.connection.execute("DELETE FROM pictures WHERE path = ?", (file_name,))
+
+    def get_directories(self, path):
+        """Returns the directory snapshot of the given path and its
+        subdirectories as a dictionary in the format of util.walk_files."""
+
+        # The subdirectories are exactly the paths between the path followed
+        # by the separator and the path followed by the next character, which
+        # can be queried using the primary key index.
+        prefix = os.path.join(path, "")
+        with self.lock:
+            rows = self.connection.execute("SELECT path, mtime, entries FROM directories WHERE path = ? OR (path >= ? AND path < ?)", (path, prefix, prefix[:-1] + chr(ord(prefix[-1]) + 1))).fetchall()
+
+        return {directory: (mtime, [tuple(x) for x in json.loads(entries)]) for directory, mtime, entries in rows}
+
+    def put_directories(self, snapshot):
+        """Stores the given directory snapshot entries in the format of
+        util.walk_files."""
+
+        rows = [(directory, mtime, json.dumps(entries)) for directory, (mtime, entries) in snapshot.items()]
+        with self.lock, self.connection:
+            self.connection.executemany("INSERT OR REPLACE INTO directories VALUES (?, ?, ?)", rows)
+
+    def remove_directories(self, directories):
+        """Removes the snapshot entries of the given directories."""
+
+        with self.lock, self.connection:
+            self.connection.executemany("DELETE FROM directories WHERE path = ?", [(directory,) for directory in directories])
+
+    def search(self, query):
+        """Returns the sorted paths of the existing files whose indexed
+        metadata entries match all words of the given query. The words are
+        matched as prefixes of the words in any entry."""
+
+        if not self.has_search:
+            return []
+
+        words = query.split()
+        if len(words) == 0:
+            return []
+        # Quote the words so that they are not interpreted as FTS5 syntax.
+        match = " ".join('"' + word.replace('"', '""') + '"*' for word in words)
+
+        with self.lock:
+            rows = self.connection.execute("SELECT pictures.path FROM pictures_fts JOIN pictures ON pictures.rowid = pictures_fts.rowid WHERE pictures_fts MATCH ?", (match,)).fetchall()
+
+        return sorted(path for path, in rows if os.path.exists(path))
+
+    def close(self):
+        """Closes the underlying database connection."""
+
+        with self.lock:
+            self.connection.close()
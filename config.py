@@ -1,4 +1,4 @@
-import configparser, pytz
+import configparser, os, pytz
 
 from exceptions import ConfigError
 from util import DotDict
@@ -33,6 +33,40 @@ def read_config_file(config_file_name):
     if "default_language" not in d.general:
         d.general.default_language = "en-US"
 
+    # The metadata catalog is disabled by setting an empty file name.
+    if "catalog" not in d.general:
+        d.general.catalog = "~/.cache/arris/catalog.sqlite"
+    d.general.catalog = d.general.catalog.strip()
+
+    # Number of worker threads for saving files and loading metadata.
+    if "workers" in d.general:
+        try:
+            d.general.workers = int(d.general.workers)
+        except ValueError as exc:
+            raise ConfigError(f"Invalid number of workers {d.general.workers}.") from exc
+        if d.general.workers < 1:
+            raise ConfigError(f"Invalid number of workers {d.general.workers}.")
+    else:
+        d.general.workers = os.cpu_count() or 1
+
+    # File extensions whose XMP metadata is kept in sidecar files.
+    if "sidecar_extensions" in d.general:
+        d.general.sidecar_extensions = [x.strip().lower() for x in d.general.sidecar_extensions.split(",") if len(x.strip()) > 0]
+    else:
+        d.general.sidecar_extensions = []
+
+    # Load the metadata of listed files in the background.
+    if "index_in_background" in d.general:
+        d.general.index_in_background = d.general.index_in_background.lower() == "true"
+    else:
+        d.general.index_in_background = True
+
+    # Overwrite XMP packets in place when they fit in the existing padding.
+    if "in_place_xmp" in d.general:
+        d.general.in_place_xmp = d.general.in_place_xmp.lower() == "true"
+    else:
+        d.general.in_place_xmp = False
+
     if "debug" in d.general:
         d.general.debug = d.general.debug.lower() == "true"
     else:
@@ -5,15 +5,22 @@ class Context(QObject):
 
     # Signaling between the application and the controller.
     update_files = Signal(str, list)
+    append_files = Signal(int, list)
+    files_listed = Signal()
     files_not_updated = Signal()
+    listing_failed = Signal(str, str)
     update_metadata = Signal(object, object, object, object, object, object, object, bool)
     file_deleted = Signal(int)
+    files_changed = Signal(list)
     ask_discard_changes = Signal()
     discard_edits = Signal()
     rename_files = Signal(list)
     answer_received = Signal(bool)
+    submit_metadata = Signal(object)
     request_directory_change = Signal(str, bool)
+    request_search = Signal(str)
     request_selected_changed = Signal(list)
+    request_prefetch = Signal(list)
     request_rename = Signal(list)
     request_delete = Signal(list)
     request_undelete = Signal(list)
@@ -22,8 +29,13 @@ class Context(QObject):
     request_adjust_time = Signal(int)
     request_adjust_utc_offset = Signal(float)
     indicate_progress = Signal(int)
+    progress_maximum = Signal(int)
+    request_cancel = Signal()
+    operation_cancelled = Signal()
 
     # State machine state change signaling.
+    enter_edited = Signal()
+    enter_not_edited = Signal()
     enter_initial = Signal()
     edit_zero_files = Signal()
     edit_one_file = Signal()
@@ -31,4 +43,5 @@ class Context(QObject):
     metadata_entry_changed = Signal()
     event_edit = Signal(list)
     saved_edits = Signal()
+    save_failed = Signal(list)
 
@@ -1,17 +1,23 @@
+from PySide6.QtCore import QObject
 from PySide6.QtStateMachine import QState, QStateMachine
 
 from util import DotDict
 
-class BaseController:
+class BaseController(QObject):
     """A base class for the controller that sets up the state machine and its
-    transitions, but does not perform any actual program logic."""
+    transitions, but does not perform any actual program logic. The controller
+    is meant to live in its own thread, so it communicates with the UI only
+    via the signals of the context."""
 
     def __init__(self, config, context):
+        super().__init__()
         self.config = config
         self.context = context
 
     def _setup_state_machine(self):
-        self.machine = QStateMachine()
+        # The state machine is a child of the controller, so it moves to the
+        # thread of the controller.
+        self.machine = QStateMachine(self)
 
         # States.
         root_state = QState()
@@ -107,14 +113,14 @@ class BaseController:
 
         if self.config.general.debug:
             print("State: edited")
-        self.app.enter_edited()
+        self.context.enter_edited.emit()
 
     def enter_not_edited(self):
         """Handles the event that the edited state changes to 'not_edited'."""
 
         if self.config.general.debug:
             print("State: not_edited")
-        self.app.enter_not_edited()
+        self.context.enter_not_edited.emit()
 
     def enter_initial(self):
         """Handles the event that the action state changes to 'initial'."""
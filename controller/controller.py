@@ -1,38 +1,173 @@
-import datetime, os, shutil
+import copy, datetime, os, shutil, sys, threading, time
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
-from PySide6.QtCore import QEventLoop
+from PySide6.QtCore import Qt, QFileSystemWatcher, QTimer
 
+from catalog import Catalog
 from controller.base import BaseController
-from picture_metadata import load_xmp_from_file, write_xmp_to_file, load_exif_from_file, write_exif_to_file, exif_timestamp_to_datetime
-from util import list_files, optimize_image, rotate_image, set_image_permissions, set_image_timestamp
+from exceptions import EXIFWriteError, XMPWriteError
+from picture_metadata import EXIF_DATE_TAGS, EXIF_THUMBNAIL_TAGS, apply_commands_to_file, exif_commands, exif_timestamp_to_datetime, file_stat, load_exif_from_files, load_metadata_from_files, sidecar_file_name, write_xmp_in_place, write_xmp_sidecar, xmp_commands
+from util import list_files, rotation_exif_tags, set_image_permissions, set_image_timestamp, transform_image, walk_files
+
+class FileRecord:
+    """The data of a current file: its path, the edited and delete flags, the
+    metadata, the pending transformations, the EXIF tags, the metadata as
+    loaded from the file, and the size and modification time of the file when
+    the metadata was loaded. The path is None if the file has been removed by
+    another program. The slots keep the records small when very many files
+    are loaded."""
+
+    __slots__ = ("path", "edited", "delete", "metadata", "transformations", "exif", "original", "stat")
+
+    def __init__(self, path):
+        self.path = path
+        self.edited = False
+        self.delete = False
+        self.metadata = None
+        self.transformations = {}
+        self.exif = None
+        self.original = None
+        self.stat = None
+
+# The identifiers accepted by Controller.get_current and set_current.
+FILE_RECORD_IDENTIFIERS = frozenset(FileRecord.__slots__)
+
+# The flags of the file records and the attributes of the controller holding
+# the indices of the files with the flag set.
+FILE_RECORD_FLAGS = {"edited": "edited_files", "delete": "deleted_files"}
+
+class SelectionAggregate:
+    """Counts the values of the metadata entries of the selected files, so
+    that the values common to all selected files are found without going
+    through all of them. Files are added to and removed from the aggregate as
+    the selection changes. Tags are counted as sets, so their order does not
+    matter."""
+
+    ENTRIES = ["author", "city", "country", "title", "description", "tags"]
+
+    def __init__(self):
+        self.counts = {entry: Counter() for entry in self.ENTRIES}
+        # The counted values of each file in the aggregate.
+        self.values = {}
+
+    def __contains__(self, idx):
+        return idx in self.values
+
+    def __iter__(self):
+        return iter(self.values)
+
+    @staticmethod
+    def _values(metadata):
+        tags = frozenset(metadata["tags"]) if metadata["tags"] is not None else None
+        return tuple(metadata[entry] for entry in SelectionAggregate.ENTRIES[:-1]) + (tags,)
+
+    def add(self, idx, metadata):
+        """Adds the metadata of the file at the given idx to the aggregate."""
+
+        values = self._values(metadata)
+        self.values[idx] = values
+        for entry, value in zip(self.ENTRIES, values):
+            self.counts[entry][value] += 1
+
+    def remove(self, idx):
+        """Removes the file at the given idx from the aggregate."""
+
+        values = self.values.pop(idx)
+        for entry, value in zip(self.ENTRIES, values):
+            counts = self.counts[entry]
+            counts[value] -= 1
+            if counts[value] == 0:
+                del counts[value]
+
+    def update(self, idx, metadata):
+        """Updates the aggregate after the metadata of the file at the given
+        idx has changed."""
+
+        if self._values(metadata) != self.values[idx]:
+            self.remove(idx)
+            self.add(idx, metadata)
+
+    def common(self, entry):
+        """Returns the value of the given entry that is common to all files in
+        the aggregate or None if there is no such value."""
+
+        counts = self.counts[entry]
+        return next(iter(counts)) if len(counts) == 1 else None
 
 class Controller(BaseController):
     """Controller for keeping the application state, updating the UI
     accordingly, and for performing filesystem operations."""
 
+    # Number of files whose metadata is loaded at a time by the background
+    # indexer.
+    INDEX_BATCH_SIZE = 32
+    # Maximum number of files and time in seconds between signaling the files
+    # found by a recursive listing.
+    LISTING_CHUNK_SIZE = 1000
+    LISTING_CHUNK_INTERVAL = 0.1
+    # Delay in milliseconds before the changes in the watched directories are
+    # handled, so that many changes are handled at once.
+    WATCH_DELAY = 500
+
     def __init__(self, config, context):
         super().__init__(config, context)
 
         self.current_path = None
+        self.current_recursive = False
         self.current_files = None
         self.currently_selected = None
-        # Give list offsets for each identifier.
-        self.offsets = {
-            "path":            0,
-            "edited":          1,
-            "delete":          2,
-            "metadata":        3,
-            "transformations": 4,
-        }
-
-        self.answer = None
-        self.loop = QEventLoop()
+        # The values of the metadata entries of the selected files.
+        self.selection = SelectionAggregate()
+        # The indices of the current files that are edited and marked for
+        # deletion. These are kept up to date by set_current.
+        self.edited_files = set()
+        self.deleted_files = set()
+
+        # The request waiting for the user to answer whether the edits should
+        # be discarded.
+        self.pending_request = None
+        # The metadata currently written in the UI metadata entries.
+        self.selected_metadata = None
+        # Set when the user cancels the current long operation.
+        self.cancel_event = threading.Event()
+
+        # The indices of the current files whose metadata is to be loaded in
+        # the background. The timer (a child of the controller, so it runs in
+        # the controller thread) fires whenever there are no other events to
+        # handle. The files to go first are pushed to the front of the queue,
+        # so an index can be in the queue more than once; the set holds the
+        # indices not yet taken from the queue.
+        self.index_queue = deque()
+        self.index_queued = set()
+        self.index_timer = QTimer(self)
+        self.index_timer.setInterval(0)
+        self.index_timer.timeout.connect(self.index_next_files)
+
+        # The directories of the current files are watched for changes made by
+        # other programs. The changed directories are collected and handled
+        # after a delay.
+        self.watcher = QFileSystemWatcher(self)
+        self.watcher.directoryChanged.connect(self.handle_directory_changed)
+        self.watched_directories = set()
+        self.changed_directories = set()
+        self.watch_timer = QTimer(self)
+        self.watch_timer.setSingleShot(True)
+        self.watch_timer.setInterval(self.WATCH_DELAY)
+        self.watch_timer.timeout.connect(self.update_changed_directories)
+
+        # The metadata catalog (if enabled).
+        self.catalog = Catalog(self.config.general.catalog, self.config.general.sidecar_extensions) if len(self.config.general.catalog) > 0 else None
 
         self._setup_state_machine()
 
         # Signals.
         self.context.request_directory_change.connect(self.handle_request_directory_change)
+        self.context.request_search.connect(self.handle_request_search)
         self.context.request_selected_changed.connect(self.handle_request_select_files)
+        self.context.request_prefetch.connect(self.handle_request_prefetch)
+        self.context.answer_received.connect(self.handle_answer_received)
+        self.context.submit_metadata.connect(self.handle_submit_metadata)
         self.context.discard_edits.connect(self.handle_discard_edits)
         self.context.event_edit.connect(self.handle_event_edit)
         self.context.request_rename.connect(self.handle_request_rename)
@@ -42,6 +177,9 @@ class Controller(BaseController):
         self.context.request_save.connect(self.handle_request_save)
         self.context.request_adjust_time.connect(self.handle_request_adjust_time)
         self.context.request_adjust_utc_offset.connect(self.handle_request_utc_offset)
+        # The controller thread is busy during a long operation, so the cancel
+        # request must be handled in the thread of the UI.
+        self.context.request_cancel.connect(self.handle_request_cancel, Qt.DirectConnection)
 
     def get_current(self, idx, identifier=None):
         """Return data for the current file at the given idx. If identifier is
@@ -50,64 +188,329 @@ class Controller(BaseController):
         if identifier is None:
             return self.current_files[idx]
 
-        if identifier not in self.offsets:
+        if identifier not in FILE_RECORD_IDENTIFIERS:
             raise ValueError(f"Unknown identifier {identifier}.")
         else:
-            return self.current_files[idx][self.offsets[identifier]]
+            return getattr(self.current_files[idx], identifier)
 
     def set_current(self, idx, identifier, value):
         """Set data for the current file at the given idx."""
 
-        if identifier not in self.offsets:
+        if identifier not in FILE_RECORD_IDENTIFIERS:
             raise ValueError(f"Unknown identifier {identifier}.")
         else:
-            self.current_files[idx][self.offsets[identifier]] = value
+            setattr(self.current_files[idx], identifier, value)
 
-    def handle_request_directory_change(self, path, recursive=False):
-        """Handles a directory change request."""
+        # Keep the indices of edited and deleted files.
+        if identifier in FILE_RECORD_FLAGS:
+            flagged = getattr(self, FILE_RECORD_FLAGS[identifier])
+            if value:
+                flagged.add(idx)
+            else:
+                flagged.discard(idx)
 
-        # If the path is already open, do nothing.
-        if path == self.current_path: return
+    def confirm_discard_edits(self, request):
+        """Checks if we have edited but unsaved metadata. If not, the given
+        request (a function without arguments) is performed immediately.
+        Otherwise the user is asked to explicitly discard the edits, and the
+        request is performed once the answer arrives and only if the edits
+        were discarded."""
 
-        # First, we check if we have edited but unchanged metadata. If so, we
-        # ask the user to explicitly discard the edits before changing the
-        # directory.
         state = self.get_state()
         if state.group_edited == "edited":
-            # There are unsaved and edited changes.
-            # If cancelled, do nothing.
-            # If discarded, emit a discard signal, change state to unedited,
-            # and continue.
+            # There are unsaved and edited changes. We do not wait for the
+            # answer here, see handle_answer_received.
+            self.pending_request = request
+            self.context.ask_discard_changes.emit()
+        else:
+            request()
 
-            # TODO: Make this a generic pattern as we will likely use it again.
+    def handle_answer_received(self, discard):
+        """Handles the answer of the user to the question whether the edits
+        should be discarded."""
 
-            def wait(answer):
-                self.answer = answer
-                self.loop.quit()
+        request = self.pending_request
+        self.pending_request = None
+        if request is None: return
 
-            self.context.answer_received.connect(wait)
-            self.context.ask_discard_changes.emit()
-            if self.answer is None:
-                self.loop.exec()
-            self.context.answer_received.disconnect(wait)
-            proceed = self.answer
-            self.answer = None
-
-            if not proceed:
-                # Do nothing, but restore the previously clicked item.
-                self.context.files_not_updated.emit()
-                return
-            else:
-                # Discard the edits (changes state).
-                self.context.discard_edits.emit()
+        if not discard:
+            # Do nothing, but restore the previously clicked item.
+            self.context.files_not_updated.emit()
+            return
+
+        # Discard the edits (changes state) and perform the request.
+        self.context.discard_edits.emit()
+        request()
+
+    def handle_request_cancel(self):
+        """Handles the request to cancel the current long operation. Notice
+        that this is called in the thread of the UI."""
+
+        self.cancel_event.set()
+
+    def close(self):
+        """Releases the resources held by the controller. This is called once
+        the thread of the controller has finished."""
+
+        if self.catalog is not None:
+            self.catalog.close()
+            self.catalog = None
+
+    def set_current_files(self, path, files):
+        """Sets the given files as the current files and signals the change."""
 
-        # Now we are going to load the contents of a new directory.
-        files = list_files(path, recursive=recursive)
         # Save the files and set the associated metadata to None.
         self.current_path = path
-        self.current_files = [[f, False, False, None, {}] for f in files] # file path, edited, delete, metadata, transformations
+        self.current_files = [FileRecord(f) for f in files]
+        self.unwatch_directories()
+        self.edited_files = set()
+        self.deleted_files = set()
         self.currently_selected = []
-        self.context.update_files.emit(path, files)
+        self.selection = SelectionAggregate()
+        self.context.update_files.emit(path if path is not None else "", files)
+
+        # Start loading the metadata of the files in the background.
+        self.index_queue = deque()
+        self.index_queued = set()
+        self.queue_index(range(len(files)))
+
+    def append_current_files(self, files):
+        """Adds the given files to the end of the current files and signals
+        the addition."""
+
+        first = len(self.current_files)
+        self.current_files.extend(FileRecord(f) for f in files)
+        self.context.append_files.emit(first, files)
+        self.queue_index(range(first, len(self.current_files)))
+
+    def queue_index(self, files_idx):
+        """Adds the given files to the background indexing queue if indexing
+        is enabled."""
+
+        if not self.config.general.index_in_background or len(files_idx) == 0: return
+
+        self.index_queue.extend(files_idx)
+        self.index_queued.update(files_idx)
+        self.index_timer.start()
+
+    def queue_index_first(self, files_idx):
+        """Moves the given files (in the given order) to the front of the
+        background indexing queue. Their earlier entries in the queue are
+        skipped when they are reached."""
+
+        self.index_queue.extendleft(reversed(files_idx))
+        self.index_queued.update(files_idx)
+
+    def list_files_recursively(self, path):
+        """Sets the files in the given path and its subdirectories as the
+        current files. The files are signaled in chunks as they are found, and
+        the listing can be cancelled by the user, in which case the files found
+        so far are kept."""
+
+        # The walk skips the subdirectories that cannot be read, but the path
+        # itself must be readable.
+        with os.scandir(path):
+            pass
+
+        self.set_current_files(path, [])
+        self.cancel_event.clear()
+
+        # The directories that have not changed since the last listing are
+        # taken from the snapshot in the catalog instead of reading them.
+        snapshot = self.catalog.get_directories(path) if self.catalog is not None else None
+        stored = {directory: mtime for directory, (mtime, _) in snapshot.items()} if snapshot is not None else {}
+
+        # All directories reached by the walk are watched, including the
+        # empty ones, so that files added to them are noticed.
+        chunk = []
+        reached = set()
+        last_signaled = time.monotonic()
+        for file_name in walk_files(path, cancel=self.cancel_event, snapshot=snapshot, directories=reached):
+            chunk.append(file_name)
+            if len(chunk) >= self.LISTING_CHUNK_SIZE or time.monotonic() - last_signaled >= self.LISTING_CHUNK_INTERVAL:
+                self.append_current_files(chunk)
+                self.watch_directories(reached)
+                reached.clear()
+                chunk = []
+                last_signaled = time.monotonic()
+        if len(chunk) > 0:
+            self.append_current_files(chunk)
+        self.watch_directories(reached)
+
+        # Store the directories that were read and forget the directories that
+        # no longer exist.
+        if snapshot is not None:
+            self.catalog.put_directories({directory: x for directory, x in snapshot.items() if stored.get(directory) != x[0]})
+            self.catalog.remove_directories([directory for directory in stored if directory not in snapshot])
+
+        if self.cancel_event.is_set():
+            # The listing is incomplete, so opening the path again lists it
+            # again.
+            self.current_path = None
+            self.context.operation_cancelled.emit()
+        else:
+            self.context.files_listed.emit()
+
+    def handle_request_directory_change(self, path, recursive=False):
+        """Handles a directory change request."""
+
+        # If the path is already open, do nothing.
+        if path == self.current_path:
+            self.context.files_listed.emit()
+            return
+
+        def change_directory():
+            # Now we are going to load the contents of a new directory. A
+            # recursive listing can take long, so its files are displayed as
+            # they are found.
+            try:
+                if recursive:
+                    self.list_files_recursively(path)
+                else:
+                    files = list_files(path)
+                    self.set_current_files(path, files)
+                    self.watch_directories([path])
+                    self.context.files_listed.emit()
+            except OSError as exc:
+                if self.current_path == path:
+                    # The files found so far are kept, but the listing is
+                    # incomplete, so opening the path again lists it again.
+                    self.current_path = None
+                else:
+                    # Nothing was listed, so the previous files remain.
+                    self.context.files_not_updated.emit()
+                self.context.listing_failed.emit(path, str(exc))
+                return
+            self.current_recursive = recursive
+
+        # First, we check if we have edited but unchanged metadata. If so, we
+        # ask the user to explicitly discard the edits before changing the
+        # directory.
+        self.confirm_discard_edits(change_directory)
+
+    def watch_directories(self, directories):
+        """Starts watching the given directories for changes made by other
+        programs."""
+
+        new = [d for d in directories if d not in self.watched_directories]
+        if len(new) == 0: return
+
+        self.watched_directories.update(new)
+        self.watcher.addPaths(new)
+
+    def unwatch_directories(self):
+        """Stops watching all directories and forgets the pending changes."""
+
+        if len(self.watched_directories) > 0:
+            self.watcher.removePaths(list(self.watched_directories))
+        self.watched_directories = set()
+        self.changed_directories = set()
+        self.watch_timer.stop()
+
+    def handle_directory_changed(self, directory):
+        """Handles the event that the contents of a watched directory have
+        changed."""
+
+        self.changed_directories.add(directory)
+        self.watch_timer.start()
+
+    def update_changed_directories(self):
+        """Updates the current files in the changed directories to match the
+        files on the disk. The files removed by other programs are removed
+        from the current files, the added files are added to the end of the
+        current files, and the metadata and thumbnails of modified files are
+        loaded again. The edits of modified files are kept."""
+
+        directories = self.changed_directories
+        self.changed_directories = set()
+        if self.current_files is None: return
+
+        listed = set()
+        reached = set()
+        for directory in list(directories):
+            if not os.path.isdir(directory):
+                # A removed directory is watched again if it is created again.
+                self.watched_directories.discard(directory)
+                continue
+            try:
+                files = list_files(directory)
+                # Hidden files are not listed recursively. The subdirectories
+                # that are not watched yet are new, so their files are added.
+                if self.current_recursive:
+                    files = [f for f in files if not os.path.basename(f).startswith(".")]
+                    with os.scandir(directory) as it:
+                        subdirectories = sorted(entry.path for entry in it if not entry.name.startswith(".") and entry.is_dir() and entry.path not in self.watched_directories)
+                    for subdirectory in subdirectories:
+                        files.extend(walk_files(subdirectory, directories=reached))
+            except OSError:
+                # The files of a directory that cannot be read are kept as
+                # they are.
+                directories.discard(directory)
+                continue
+            listed.update(files)
+        self.watch_directories(reached)
+
+        known = {}
+        for idx, record in enumerate(self.current_files):
+            if record.path is not None and os.path.dirname(record.path) in directories:
+                known[record.path] = idx
+
+        removed = [idx for file_name, idx in known.items() if file_name not in listed]
+        modified = []
+        for file_name, idx in known.items():
+            if file_name not in listed: continue
+            stat = self.get_current(idx, "stat")
+            if stat is None or self.get_current(idx, "edited"): continue
+            if file_stat(file_name, self.config.general.sidecar_extensions) != stat:
+                modified.append(idx)
+        added = sorted(listed - known.keys())
+
+        # Removed files are forgotten including their edits. Their records
+        # are kept, so that the indices of the other files do not change.
+        for idx in sorted(removed, reverse=True):
+            if self.catalog is not None:
+                self.catalog.remove([self.get_current(idx, "path")])
+            self.set_current(idx, "edited", False)
+            self.set_current(idx, "delete", False)
+            for identifier in ["path", "metadata", "original", "exif", "stat"]:
+                self.set_current(idx, identifier, None)
+            if idx in self.selection:
+                self.selection.remove(idx)
+            self.context.file_deleted.emit(idx)
+        if len(removed) > 0 and self.currently_selected is not None:
+            removed = set(removed)
+            self.currently_selected = [idx for idx in self.currently_selected if idx not in removed]
+
+        if len(modified) > 0:
+            for idx in modified:
+                for identifier in ["metadata", "original", "exif", "stat"]:
+                    self.set_current(idx, identifier, None)
+            self.load_metadata(modified)
+            for idx in modified:
+                if idx in self.selection and self.get_current(idx, "metadata") is not None:
+                    self.selection.update(idx, self.get_current(idx, "metadata"))
+            self.context.files_changed.emit(modified)
+
+        if len(added) > 0:
+            self.append_current_files(added)
+
+    def handle_request_search(self, query):
+        """Handles the request to list the files in the catalog whose metadata
+        matches the given query."""
+
+        if self.catalog is None: return
+
+        def show_results():
+            # The search results are not in a single directory, so we display
+            # them relative to their common parent directory.
+            files = self.catalog.search(query)
+            path = os.path.commonpath([os.path.dirname(f) for f in files]) if len(files) > 0 else None
+            self.set_current_files(path, files)
+            # No directory is open, so a directory change always loads the
+            # files.
+            self.current_path = None
+
+        self.confirm_discard_edits(show_results)
 
     def handle_discard_edits(self):
         """Handles the request to discard all edits."""
@@ -116,6 +519,13 @@ class Controller(BaseController):
         self.current_path = None
         self.current_files = None
         self.currently_selected = None
+        self.selection = SelectionAggregate()
+        self.edited_files = set()
+        self.deleted_files = set()
+        self.index_queue.clear()
+        self.index_queued.clear()
+        self.index_timer.stop()
+        self.unwatch_directories()
 
     def set_metadata(self, files_idx, metadata):
         """Sets the metadata of the specified files."""
@@ -126,55 +536,190 @@ class Controller(BaseController):
         # is set to None. If there are multiple files, value None means that
         # nothing is done.
         multiple = len(files_idx) > 1
+        records = self.current_files
         for idx in files_idx:
             for k in metadata:
                 if not multiple or (multiple and metadata[k] is not None):
-                    self.get_current(idx, "metadata")[k] = metadata[k]
+                    records[idx].metadata[k] = metadata[k]
+
+    def handle_submit_metadata(self, metadata):
+        """Handles the metadata currently written in the UI metadata entries.
+        The UI submits the metadata before the requests that need it."""
+
+        self.selected_metadata = metadata
 
     def save_selected_metadata(self):
-        """Gets the metadata of the selected and edited files from the UI, and
-        saves it."""
+        """Saves the metadata submitted by the UI to the selected and edited
+        files."""
+
+        if self.selected_metadata is None: return
 
-        edited = [idx for idx in self.currently_selected if self.get_current(idx, "edited")]
+        records = self.current_files
+        edited = [idx for idx in self.currently_selected if records[idx].edited]
         if len(edited) > 0:
-            metadata_for_edited = self.app.get_metadata()
-            self.set_metadata(edited, metadata_for_edited)
+            self.set_metadata(edited, self.selected_metadata)
+            # Keep the counted values of the selected files up to date.
+            for idx in edited:
+                if idx in self.selection:
+                    self.selection.update(idx, records[idx].metadata)
+
+    def update_selection(self, files_idx):
+        """Updates the counted values of the metadata entries to match the
+        given selected files. Only the files added to or removed from the
+        selection are counted."""
+
+        selected = set(files_idx)
+        for idx in [idx for idx in self.selection if idx not in selected]:
+            self.selection.remove(idx)
+        records = self.current_files
+        for idx in files_idx:
+            if idx not in self.selection:
+                self.selection.add(idx, records[idx].metadata)
+
+    def set_loaded_metadata(self, idx, metadata, exif):
+        """Sets the metadata and EXIF tags loaded from the file at the given
+        idx. The loaded metadata is kept as the original metadata, so that
+        only the changed entries are written when the file is saved."""
+
+        # The same authors, places, and tags occur in many files, so we keep
+        # only one copy of each string.
+        for entry in ["author", "city", "country"]:
+            if metadata[entry] is not None:
+                metadata[entry] = sys.intern(metadata[entry])
+        if metadata["tags"] is not None:
+            metadata["tags"] = [sys.intern(tag) for tag in metadata["tags"]]
+
+        # If there is no XMP date time in the file, attempt to load this
+        # information from EXIF tags. The original metadata includes this date
+        # time, so it is not by itself a change to be written.
+        if metadata["date_time"] is None and "Exif.Image.DateTime" in exif:
+            metadata = copy.copy(metadata)
+            metadata["date_time"] = exif_timestamp_to_datetime(exif["Exif.Image.DateTime"], time_zone=self.config.general.default_time_zone)
+
+        self.set_current(idx, "original", metadata)
+        metadata = copy.copy(metadata)
+        if metadata["tags"] is not None:
+            metadata["tags"] = list(metadata["tags"])
+        self.set_current(idx, "metadata", metadata)
+        self.set_current(idx, "exif", exif)
+        # Changes made to the file by other programs are noticed by comparing
+        # its size and modification time to these.
+        self.set_current(idx, "stat", file_stat(self.get_current(idx, "path"), self.config.general.sidecar_extensions))
+
+    def load_metadata(self, files_idx, callback=None, cancel=None):
+        """Loads the metadata and the EXIF date times of the given files unless
+        they are already loaded. The metadata of unchanged files is taken from
+        the catalog. The remaining files are read in batches by a pool of
+        workers to avoid starting exiv2 once per file and to read many files at
+        once. If callback is given, it is called with the number of files
+        handled so far. Loading can be cancelled via cancel (a threading.Event)
+        in which case the files loaded so far are kept. Returns True if and
+        only if the metadata of all given files was loaded."""
+
+        records = self.current_files
+        not_loaded = [idx for idx in files_idx if records[idx].metadata is None]
+        file_names = [records[idx].path for idx in not_loaded]
+        cataloged = self.catalog.get(file_names) if self.catalog is not None else {}
+        for idx, file_name in zip(not_loaded, file_names):
+            if file_name in cataloged:
+                self.set_loaded_metadata(idx, *cataloged[file_name])
+        not_loaded = [idx for idx in not_loaded if records[idx].metadata is None]
+
+        loaded_count = len(files_idx) - len(not_loaded)
+        if callback is not None:
+            callback(loaded_count)
+        if len(not_loaded) == 0:
+            return True
+
+        file_names = [records[idx].path for idx in not_loaded]
+        result = load_metadata_from_files(
+            file_names,
+            exif_tags=EXIF_DATE_TAGS,
+            default_time_zone=self.config.general.default_time_zone,
+            ignore_errors=True,
+            callback=lambda n: callback(loaded_count + n) if callback is not None else None,
+            cancel=cancel,
+            sidecar_extensions=self.config.general.sidecar_extensions,
+            workers=self.config.general.workers
+        )
+        for idx, file_name in zip(not_loaded, file_names):
+            if file_name not in result: continue
+            self.set_loaded_metadata(idx, *result[file_name])
+
+        if self.catalog is not None:
+            self.catalog.put(result)
+
+        return len(result) == len(not_loaded)
+
+    def index_next_files(self):
+        """Loads the metadata of the next few files in the background indexing
+        queue. This is called repeatedly by the index timer, so the requests of
+        the user are handled between the calls."""
+
+        batch = []
+        while len(self.index_queue) > 0 and len(batch) < self.INDEX_BATCH_SIZE:
+            idx = self.index_queue.popleft()
+            # Skip the entries of files already taken from the queue.
+            if idx not in self.index_queued: continue
+            self.index_queued.discard(idx)
+            if self.current_files is None or idx >= len(self.current_files): continue
+            if self.get_current(idx, "metadata") is not None or self.get_current(idx, "delete"): continue
+            # The file might have been removed by someone else.
+            if self.get_current(idx, "path") is None or not os.path.exists(self.get_current(idx, "path")): continue
+            batch.append(idx)
+
+        if len(self.index_queue) == 0:
+            self.index_timer.stop()
+
+        if len(batch) > 0:
+            self.load_metadata(batch)
+
+    def handle_request_prefetch(self, files_idx):
+        """Handles the request to load the metadata of the given files (in the
+        given order) before the other files in the background indexing
+        queue."""
+
+        if self.current_files is None: return
+
+        self.queue_index_first(files_idx)
+        self.index_timer.start()
 
     def handle_request_select_files(self, files_idx):
         """Handles the request to edit the metadata of the given files."""
 
         # Before changing the selection, we save the changes in selected and
-        # edited files.
+        # edited files. The submitted metadata belongs to the old selection.
         self.save_selected_metadata()
+        self.selected_metadata = None
 
         if len(files_idx) == 0:
             self.currently_selected = []
+            self.selection = SelectionAggregate()
             self.context.edit_zero_files.emit()
             return
 
-        # First, we load the metadata from the files if necessary so that the
-        # data is available later.
-        # NOTE: This can be slow for many files. Maybe this should be cancellable?
-        for n, idx in enumerate(files_idx):
-            file_name = self.get_current(idx, "path")
-            if self.get_current(idx, "metadata") is None:
-                # No data loaded yet, load it from file.
-                try:
-                    metadata = load_xmp_from_file(file_name, default_time_zone=self.config.general.default_time_zone, ignore_errors=True)
-                    # If there is no XMP date time in the file, attempt to load
-                    # this information from EXIF tags.
-                    if metadata["date_time"] is None:
-                        r = load_exif_from_file(file_name, ["Exif.Image.DateTime"])
-                        if "Exif.Image.DateTime" in r:
-                            metadata["date_time"] = exif_timestamp_to_datetime(r["Exif.Image.DateTime"], time_zone=self.config.general.default_time_zone)
-
-                    self.set_current(idx, "metadata", metadata)
-                except:
-                    # TODO: Exception handling.
-                    raise
+        # The selected files go first in the background indexing queue. This
+        # matters only if loading them below is cancelled.
+        if self.index_timer.isActive():
+            self.queue_index_first(files_idx)
 
+        # First, we load the metadata from the files if necessary so that the
+        # data is available later (most likely the background indexer has
+        # already loaded it). Loading can be cancelled by the user.
+        self.cancel_event.clear()
+        loaded = self.load_metadata(
+            files_idx,
             # Signal how many files have been handled.
-            self.context.indicate_progress.emit(n + 1)
+            callback=self.context.indicate_progress.emit,
+            cancel=self.cancel_event
+        )
+        if not loaded:
+            # Loading was cancelled, so nothing is selected for editing.
+            self.currently_selected = []
+            self.selection = SelectionAggregate()
+            self.context.edit_zero_files.emit()
+            self.context.operation_cancelled.emit()
+            return
 
         if len(files_idx) == 1:
             # Edit a single file's metadata.
@@ -195,6 +740,7 @@ class Controller(BaseController):
 
             # Set the currently selected files.
             self.currently_selected = [idx]
+            self.update_selection(self.currently_selected)
 
             # Change state.
             self.context.edit_one_file.emit()
@@ -204,23 +750,15 @@ class Controller(BaseController):
             # We figure out the common values in all entries. The entries with
             # a common value, we set to contain that value; other entries are
             # set to None. Datetime is always set None as its common value
-            # rarely makes sense.
-            common_entries = {}
-            for entry in ["author", "city", "country", "title", "description"]:
-                entries = list({self.get_current(idx, "metadata")[entry] for idx in files_idx})
-                common_entry = entries[0] if len(entries) == 1 else None
-                common_entries[entry] = common_entry
+            # rarely makes sense. The values are counted incrementally as the
+            # selection changes.
+            self.update_selection(files_idx)
+            common_entries = {entry: self.selection.common(entry) for entry in SelectionAggregate.ENTRIES}
             common_entries["date_time"] = None
-            # We handle tags separately as we want to check equality up to
-            # order.
-            # NOTE: This is done simply but not necessarily efficiently if
-            # there are really many selected files.
-            tags = []
-            for file_tags in [self.get_current(idx, "metadata")["tags"] for idx in files_idx]:
-                tag_set = set(file_tags) if file_tags is not None else None
-                if tag_set not in tags:
-                    tags.append(tag_set)
-            common_entries["tags"] = (list(tags[0]) if tags[0] is not None else None) if len(tags) == 1 else None
+            # Tags are equal up to order, so we display the tags of one of the
+            # files in their original order.
+            if common_entries["tags"] is not None:
+                common_entries["tags"] = list(self.get_current(files_idx[0], "metadata")["tags"])
 
             self.context.update_metadata.emit(
                 common_entries["author"],
@@ -307,98 +845,264 @@ class Controller(BaseController):
             self.get_current(idx, "transformations")["rotate"] = (self.get_current(idx, "transformations")["rotate"] + 90) % 360
 
     def handle_request_save(self, optimize=False):
-        """Handles the event that the edited files are requested to be saved."""
+        """Handles the event that the edited files are requested to be saved.
+        If some files cannot be saved, the save_failed signal is emitted with
+        the pairs (file name, error message) of all failed files, and the
+        failed files remain edited."""
 
         # Save the changes in selected edited files.
         self.save_selected_metadata()
 
-        for n, idx in enumerate(range(len(self.current_files))):
+        # The EXIF date times were read together with the metadata when the
+        # files were selected. Load them at once for the files where this is
+        # not the case. Writing the XMP tags below does not change the EXIF
+        # tags.
+        to_write = sorted(self.edited_files - self.deleted_files)
+        records = self.current_files
+        not_loaded = [records[idx].path for idx in to_write if records[idx].exif is None]
+        if len(not_loaded) > 0:
+            try:
+                exif_data = load_exif_from_files(not_loaded, EXIF_DATE_TAGS)
+            except Exception as exc:
+                self.context.save_failed.emit([(file_name, str(exc)) for file_name in not_loaded])
+                return
+            for idx in to_write:
+                if records[idx].exif is None:
+                    records[idx].exif = exif_data[records[idx].path]
+
+        # Remove the files marked for deletion. Notice that this must be done
+        # before the edited files are saved, so that the deleted files do not
+        # affect renaming. The files are removed from the last to the first,
+        # which is fastest for the UI.
+        errors = []
+        for idx in sorted(self.deleted_files, reverse=True):
             file_name = self.get_current(idx, "path")
-            metadata = self.get_current(idx, "metadata")
-            transformations = self.get_current(idx, "transformations")
-
-            # Remove the file if requested.
-            # Notice that this must be done before we consider if a file has
-            # been edited.
-            if self.get_current(idx, "delete"):
+            try:
                 # Only delete if the file exists (the file might have already
                 # been removed by a previous save event).
                 if os.path.exists(file_name):
                     os.unlink(file_name)
-                self.context.file_deleted.emit(idx)
-                self.context.indicate_progress.emit(n + 1)
-                continue
-
-            # Skip files that have not been edited.
-            if not self.get_current(idx, "edited"):
-                self.context.indicate_progress.emit(n + 1)
+                # The sidecar file is deleted with the file.
+                sidecar = sidecar_file_name(file_name, self.config.general.sidecar_extensions)
+                if sidecar is not None and os.path.exists(sidecar):
+                    os.unlink(sidecar)
+            except OSError as exc:
+                errors.append((file_name, str(exc)))
                 continue
+            if self.catalog is not None:
+                self.catalog.remove([file_name])
+            self.context.file_deleted.emit(idx)
+
+        # The same file can be listed more than once through symbolic links.
+        # Its copies must not be written in parallel, so only the first one is
+        # saved and the others remain edited.
+        saved = {}
+        for idx in list(to_write):
+            file_name = self.get_current(idx, "path")
+            real_name = os.path.realpath(file_name)
+            if real_name in saved:
+                errors.append((file_name, f"The file is the same as '{saved[real_name]}', which is saved instead."))
+                to_write.remove(idx)
+            else:
+                saved[real_name] = file_name
+
+        # The progress counts the files to write.
+        handled = 0
+        self.context.progress_maximum.emit(len(to_write))
+
+        # Save the edited files independently of each other in a pool of
+        # worker threads (the work is mostly done by external tools). Renames
+        # are serialized over the whole pool, and the rename targets are kept
+        # to check that no two files are renamed to the same file.
+        # The saving can be cancelled by the user in which case the files that
+        # are not yet being saved are left as they are.
+        self.rename_lock = threading.Lock()
+        self.rename_targets = set()
+        self.cancel_event.clear()
+        with ThreadPoolExecutor(max_workers=self.config.general.workers) as executor:
+            futures = {executor.submit(self.save_file, idx, optimize): idx for idx in to_write}
+            for future in as_completed(futures):
+                if future.cancelled(): continue
+                try:
+                    future.result()
+                except Exception as exc:
+                    errors.append((self.get_current(futures[future], "path"), str(exc)))
+
+                # Signal how many files have been handled.
+                handled += 1
+                self.context.indicate_progress.emit(handled)
+
+                if self.cancel_event.is_set():
+                    for f in futures:
+                        f.cancel()
+
+        # The files that failed to save or whose saving was cancelled remain
+        # edited.
+        if len(errors) > 0:
+            self.context.save_failed.emit(errors)
+            return
 
-            # Write the XMP tags.
-            write_xmp_to_file(file_name, metadata, language=self.config.general.default_language, ignore_errors=True)
+        if any(future.cancelled() for future in futures):
+            self.context.operation_cancelled.emit()
+            return
 
-            # Check if XMP date time and existing EXIF tag date times mismatch,
-            # and update EXIF tags if necessary.
-            #
-            # First we list some possible tags that contain the date time. This
-            # list is probably not exhaustive.
-            exif_tags = [
-                "Exif.Image.DateTime",
-                "Exif.Photo.DateTimeOriginal",
-                "Exif.Photo.DateTimeDigitized",
-                "Exif.SonySInfo1.SonyDateTime"
-            ]
-            r = load_exif_from_file(file_name, exif_tags)
-            s_xmp = metadata["date_time"].strftime("%Y:%m:%d %H:%M:%S") if metadata["date_time"] is not None else None
-            updated = {}
-            for tag in exif_tags:
-                if tag in r:
-                    dt_exif = exif_timestamp_to_datetime(r[tag])
-                    s_exif = dt_exif.strftime("%Y:%m:%d %H:%M:%S")
-                    if s_exif != s_xmp:
-                        updated[tag] = s_xmp
-            if len(updated) > 0:
-                write_exif_to_file(file_name, updated)
-
-            # Perform transformations.
-            # Rotation.
-            if "rotate" in transformations:
-                angle = transformations["rotate"]
-                rotate_image(file_name, angle)
-                self.get_current(idx, "transformations")["rotate"] = 0
-            # Rename.
-            if "rename" in transformations:
-                new_file_name = os.path.join(os.path.dirname(file_name), transformations["rename"])
-                if file_name != new_file_name:
-                    prefix = ".".join(transformations["rename"].split(".")[:-1])
-                    extension = transformations["rename"].split(".")[-1]
-                    count = 1
-                    while os.path.exists(new_file_name):
-                        new_file_name = os.path.join(os.path.dirname(file_name), f"{prefix} ({count}).{extension}")
-                        count += 1
-                    shutil.move(file_name, new_file_name)
-                    self.set_current(idx, "path", new_file_name)
-                    file_name = new_file_name
+        self.context.saved_edits.emit()
 
-            # Optimize.
-            if optimize:
-                optimize_image(file_name)
+    def save_file(self, idx, optimize=False):
+        """Saves the edited file at the given idx. This is called from the
+        worker threads of handle_request_save."""
 
-            # Set the edit times to match the date time.
-            dt = metadata["date_time"]
-            if dt is not None:
-                set_image_timestamp(file_name, dt)
+        file_name = self.get_current(idx, "path")
+        metadata = self.get_current(idx, "metadata")
+        transformations = self.get_current(idx, "transformations")
 
-            # Set permissions to 644.
-            set_image_permissions(file_name)
+        # Plan the changes of the file before touching it. The metadata changes
+        # (changed XMP tags, mismatching EXIF date times, EXIF orientation,
+        # and thumbnail removal) are collected into a single list of exiv2
+        # commands.
+        xmp, exif, updated = self.plan_metadata_commands(idx, optimize)
 
-            # Set the edited flag to False.
+        # Leave the file untouched if nothing actually differs.
+        angle = transformations.get("rotate", 0)
+        renamed = "rename" in transformations and transformations["rename"] != os.path.basename(file_name)
+        if len(xmp) == 0 and len(exif) == 0 and angle == 0 and not renamed and not optimize:
             self.set_current(idx, "edited", False)
+            return
 
-            # Signal how many files have been handled.
-            self.context.indicate_progress.emit(n + 1)
+        # Write the XMP tags to the sidecar file if the file uses one. A new
+        # sidecar gets all metadata entries.
+        sidecar = sidecar_file_name(file_name, self.config.general.sidecar_extensions)
+        if sidecar is not None and len(xmp) > 0:
+            original = self.get_current(idx, "original") if os.path.exists(sidecar) else None
+            write_xmp_sidecar(sidecar, metadata, self.config.general.default_language, original=original)
+            xmp = []
+
+        # If only XMP tags change, try to overwrite the XMP packet of the file
+        # in place instead of rewriting the whole file.
+        in_place = False
+        if self.config.general.in_place_xmp and len(xmp) > 0 and len(exif) == 0 and angle == 0 and not optimize:
+            in_place = write_xmp_in_place(file_name, metadata, self.config.general.default_language, original=self.get_current(idx, "original"))
+
+        if not in_place and (len(xmp) > 0 or len(exif) > 0 or angle != 0 or optimize):
+            # Perform the pixel transformations (rotation and optimization) in
+            # a single lossless pass. The result is a temporary file that
+            # replaces the original below.
+            work_file = transform_image(file_name, angle=angle, optimize=optimize)
+
+            try:
+                # Write all metadata in one exiv2 call after the pixel
+                # transformations (which copy the existing metadata). If
+                # writing fails, the file remains edited.
+                apply_commands_to_file(work_file, xmp + exif, EXIFWriteError if len(exif) > 0 else XMPWriteError)
+
+                # Replace the file with the transformed file.
+                if work_file != file_name:
+                    os.replace(work_file, file_name)
+            finally:
+                if work_file != file_name and os.path.exists(work_file):
+                    os.remove(work_file)
+
+            # Keep the stored EXIF date times in sync with the file now that
+            # they have been written.
+            exif_tags = self.get_current(idx, "exif")
+            for tag, value in updated.items():
+                if tag not in EXIF_DATE_TAGS: continue
+                if value is None:
+                    exif_tags.pop(tag, None)
+                else:
+                    exif_tags[tag] = value
+        if "rotate" in transformations:
+            transformations["rotate"] = 0
+
+        # Rename.
+        if "rename" in transformations:
+            directory = os.path.dirname(file_name)
+            new_file_name = os.path.join(directory, transformations["rename"])
+            if file_name != new_file_name:
+                prefix = ".".join(transformations["rename"].split(".")[:-1])
+                extension = transformations["rename"].split(".")[-1]
+                # Finding a free name and moving the file must not be
+                # interleaved with other renames. The same directory can be
+                # reached through different paths, so renames are not only
+                # serialized per directory.
+                with self.rename_lock:
+                    # A name is free only if its sidecar is free as well, as
+                    # an existing sidecar would be overwritten or adopted.
+                    def taken(name):
+                        sidecar = sidecar_file_name(name, self.config.general.sidecar_extensions)
+                        return os.path.exists(name) or (sidecar is not None and os.path.exists(sidecar)) or os.path.realpath(name) in self.rename_targets
 
-        self.context.saved_edits.emit()
+                    count = 1
+                    while taken(new_file_name):
+                        new_file_name = os.path.join(directory, f"{prefix} ({count}).{extension}")
+                        count += 1
+                    target = os.path.realpath(new_file_name)
+                    assert target not in self.rename_targets, f"Two files renamed to '{target}'."
+                    self.rename_targets.add(target)
+                    shutil.move(file_name, new_file_name)
+                    # The sidecar file moves with the file.
+                    sidecar = sidecar_file_name(file_name, self.config.general.sidecar_extensions)
+                    if sidecar is not None and os.path.exists(sidecar):
+                        shutil.move(sidecar, sidecar_file_name(new_file_name, self.config.general.sidecar_extensions))
+                if self.catalog is not None:
+                    self.catalog.remove([file_name])
+                self.set_current(idx, "path", new_file_name)
+                file_name = new_file_name
+            del transformations["rename"]
+
+        # Set the edit times to match the date time.
+        dt = metadata["date_time"]
+        if dt is not None:
+            set_image_timestamp(file_name, dt)
+
+        # Set permissions to 644.
+        set_image_permissions(file_name)
+
+        # Update the catalog entry of the file.
+        if self.catalog is not None:
+            self.catalog.put({file_name: (metadata, self.get_current(idx, "exif"))})
+
+        # The file now contains the edited metadata.
+        self.set_current(idx, "original", copy.deepcopy(metadata))
+        self.set_current(idx, "stat", file_stat(file_name, self.config.general.sidecar_extensions))
+
+        # Set the edited flag to False.
+        self.set_current(idx, "edited", False)
+
+    def plan_metadata_commands(self, idx, optimize=False):
+        """Returns the exiv2 modify commands that write all metadata changes of
+        the file at the given idx when it is saved as a triple (XMP commands,
+        EXIF commands, EXIF tags). The EXIF tags map the changed tags to their
+        new values (None for removed tags). The EXIF orientation commands
+        assume that the file is rotated with transform_image. Nothing is
+        changed before the commands have been applied."""
+
+        file_name = self.get_current(idx, "path")
+        metadata = self.get_current(idx, "metadata")
+        transformations = self.get_current(idx, "transformations")
+
+        # Check if XMP date time and existing EXIF tag date times mismatch,
+        # and update EXIF tags if necessary.
+        r = self.get_current(idx, "exif")
+        s_xmp = metadata["date_time"].strftime("%Y:%m:%d %H:%M:%S") if metadata["date_time"] is not None else None
+        updated = {}
+        for tag in EXIF_DATE_TAGS:
+            if tag in r:
+                dt_exif = exif_timestamp_to_datetime(r[tag])
+                s_exif = dt_exif.strftime("%Y:%m:%d %H:%M:%S")
+                if s_exif != s_xmp:
+                    updated[tag] = s_xmp
+
+        # The EXIF orientation needs to be changed for rotation.
+        if transformations.get("rotate", 0) != 0:
+            updated.update(rotation_exif_tags(file_name, transformations["rotate"]))
+
+        # Remove the embedded thumbnail when optimizing.
+        if optimize:
+            updated.update({tag: None for tag in EXIF_THUMBNAIL_TAGS})
+
+        original = self.get_current(idx, "original")
+        return xmp_commands(metadata, self.config.general.default_language, original=original), exif_commands(updated), updated
 
     def handle_request_adjust_time(self, seconds):
         """Handles the event that the given number of seconds should be added
@@ -30,6 +30,16 @@ class EXIFWriteError(Exception):
     def __str__(self):
         return f"While writing EXIF metadata to file '{self.file_name}', the following error occurred: '{self.message}'."
 
+class TransformError(Exception):
+    """Exception class for errors while transforming the pixels of images."""
+
+    def __init__(self, file_name, message):
+        super().__init__()
+        self.file_name = file_name
+        self.message = message
+
+    def __str__(self):
+        return f"While transforming the image in file '{self.file_name}', the following error occurred: '{self.message}'."
 
 class XMPReadError(Exception):
     """Exception class for errors while reading XMP metadata."""
@@ -1,8 +1,10 @@
-import copy, os, pytz
+import copy, io, os, pytz, stat, struct, tempfile, threading, zlib
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
 from subprocess import Popen, PIPE
+from xml.etree import ElementTree
 
-from exceptions import EXIFReadError, EXIFWriteError, XMPReadError, XMPWriteError
+from exceptions import EXIFReadError, XMPReadError, XMPWriteError
 
 def get_empty_picture_data():
     d = dict(
@@ -17,58 +19,535 @@ def get_empty_picture_data():
 
     return d
 
-def load_xmp_from_file(file_name, default_time_zone=None, ignore_errors=False):
-    """Loads XMP metadata entries from the given file. If flag ignore_errors is
-    true, then attempt to fetch the metadata even in presence of some errors
-    from the exiv2 tool."""
+# The XMP tags of the supported metadata entries and the corresponding keys of
+# the picture data.
+XMP_TAGS = {
+    "Xmp.dc.creator":          "author",
+    "Xmp.dc.date":             "date_time",
+    "Xmp.iptcExt.City":        "city",
+    "Xmp.iptcExt.CountryName": "country",
+    "Xmp.dc.title":            "title",
+    "Xmp.dc.description":      "description",
+    "Xmp.dc.subject":          "tags",
+}
 
-    if not os.path.exists(file_name):
-        raise IOError(f"File '{file_name}' does not exist.")
+# File extensions whose XMP packet we locate and parse ourselves instead of
+# calling exiv2.
+XMP_NATIVE_EXTENSIONS = ["jpg", "jpeg", "png"]
+
+# XML namespaces of the supported XMP tags and their exiv2 prefixes.
+XMP_NAMESPACES = {
+    "http://purl.org/dc/elements/1.1/":            "dc",
+    "http://iptc.org/std/Iptc4xmpExt/2008-02-29/": "iptcExt",
+}
+
+RDF_NAMESPACE = "http://www.w3.org/1999/02/22-rdf-syntax-ns#"
+XML_LANG = "{http://www.w3.org/XML/1998/namespace}lang"
+
+# Possible EXIF tags that contain the date time. This list is probably not
+# exhaustive.
+EXIF_DATE_TAGS = [
+    "Exif.Image.DateTime",
+    "Exif.Photo.DateTimeOriginal",
+    "Exif.Photo.DateTimeDigitized",
+    "Exif.SonySInfo1.SonyDateTime"
+]
+
+# EXIF tags that can be read without exiv2 and their locations as pairs (IFD
+# group, tag number). The group Image is IFD0; other groups are subdirectories
+# of IFD0 pointed to by the tags in EXIF_NATIVE_GROUPS.
+EXIF_NATIVE_TAGS = {
+    "Exif.Image.Make":              ("Image", 0x010F),
+    "Exif.Image.Orientation":       ("Image", 0x0112),
+    "Exif.Image.DateTime":          ("Image", 0x0132),
+    "Exif.Photo.DateTimeOriginal":  ("Photo", 0x9003),
+    "Exif.Photo.DateTimeDigitized": ("Photo", 0x9004),
+}
+EXIF_NATIVE_GROUPS = {
+    "Photo": 0x8769,
+}
+
+# File extensions whose EXIF tags we read ourselves.
+EXIF_NATIVE_EXTENSIONS = ["cr2", "jpg", "jpeg", "png", "rw2"]
+
+# Maker note tags and the camera make (as given by Exif.Image.Make) of the files
+# in which they can occur.
+EXIF_MAKER_NOTE_TAGS = {
+    "Exif.SonySInfo1.SonyDateTime": "SONY",
+}
+
+# The EXIF tags of the embedded thumbnail (IFD1). Deleting them removes the
+# thumbnail like 'exiv2 -dt' does.
+EXIF_THUMBNAIL_TAGS = [
+    "Exif.Thumbnail.ImageWidth",
+    "Exif.Thumbnail.ImageLength",
+    "Exif.Thumbnail.BitsPerSample",
+    "Exif.Thumbnail.Compression",
+    "Exif.Thumbnail.PhotometricInterpretation",
+    "Exif.Thumbnail.StripOffsets",
+    "Exif.Thumbnail.Orientation",
+    "Exif.Thumbnail.SamplesPerPixel",
+    "Exif.Thumbnail.RowsPerStrip",
+    "Exif.Thumbnail.StripByteCounts",
+    "Exif.Thumbnail.XResolution",
+    "Exif.Thumbnail.YResolution",
+    "Exif.Thumbnail.PlanarConfiguration",
+    "Exif.Thumbnail.ResolutionUnit",
+    "Exif.Thumbnail.JPEGInterchangeFormat",
+    "Exif.Thumbnail.JPEGInterchangeFormatLength",
+    "Exif.Thumbnail.YCbCrCoefficients",
+    "Exif.Thumbnail.YCbCrSubSampling",
+    "Exif.Thumbnail.YCbCrPositioning",
+    "Exif.Thumbnail.ReferenceBlackWhite",
+]
+
+# Maximum number of files given to a single exiv2 invocation. This keeps the
+# command line well below the argument length limits of the operating system.
+BATCH_SIZE = 200
+
+def _batches(file_names, size=BATCH_SIZE):
+    """Generates consecutive batches of at most the given size from the list of
+    file names."""
+
+    for i in range(0, len(file_names), size):
+        yield file_names[i:i + size]
+
+def _split_exiv2_output(file_names, output):
+    """Splits the standard output of an exiv2 print call into output lines per
+    file. When exiv2 is given more than one file, it prefixes every output line
+    with the file name padded to 20 characters and followed by two spaces. The
+    output is in the order of the given files, which lets us disambiguate file
+    names that are prefixes of each other."""
+
+    lines = {file_name: [] for file_name in file_names}
+    if len(file_names) == 1:
+        lines[file_names[0]] = [line.decode("utf-8") for line in output.splitlines()]
+        return lines
+
+    encoded = [(file_name, file_name.encode("utf-8")) for file_name in file_names]
+    current = 0
+    for line in output.splitlines():
+        for n in range(current, len(encoded)):
+            file_name, prefix = encoded[n]
+            if line.startswith(prefix) and line[len(prefix):len(prefix) + 2] == b"  ":
+                lines[file_name].append(line[len(prefix):].lstrip(b" ").decode("utf-8"))
+                current = n
+                break
+
+    return lines
+
+def _parse_xmp_date(value, default_time_zone=None):
+    """Parses an XMP date time in ISO format."""
+
+    value = datetime.fromisoformat(value)
+    # It is possible that the UTC offset is now None, so we set it to the
+    # default.
+    if value.utcoffset() is None and default_time_zone is not None:
+        value = pytz.timezone(default_time_zone).localize(value)
+
+    return value
+
+def _parse_xmp_lines(lines, default_time_zone=None):
+    """Parses the lines printed by 'exiv2 -px' for a single file into picture
+    data."""
 
     data = get_empty_picture_data()
 
-    result = Popen(["exiv2", "-px", "pr", file_name], stdout=PIPE, stderr=PIPE).communicate()
-    if len(result[1]) > 0 and not ignore_errors:
-        raise XMPReadError(file_name, result[1].decode("utf-8"))
-
-    has_language = ["dc.title", "dc.description"]
-    for line in result[0].splitlines():
-        line = line.decode("utf-8")
-        pieces = line.split()
-
-        tag_name = pieces[0][4:]
-        value = pieces[3:] if tag_name not in has_language else pieces[4:]
-        value = " ".join(value)
-
-        if tag_name == "dc.creator":
-            k = "author"
-        elif tag_name == "dc.date":
-            k = "date_time"
-            value = datetime.fromisoformat(value)
-            # It is possible that the UTC offset is now None, so we set it to
-            # the default.
-            if value.utcoffset() is None and default_time_zone is not None:
-                value = pytz.timezone(default_time_zone).localize(value)
-        elif tag_name == "iptcExt.City":
-            k = "city"
-        elif tag_name == "iptcExt.CountryName":
-            k = "country"
-        elif tag_name == "dc.title":
-            k = "title"
-        elif tag_name == "dc.description":
-            k = "description"
-        elif tag_name == "dc.subject":
-            k = "tags"
+    for line in lines:
+        # The columns are key, type, count, and value. We split only up to the
+        # value to preserve its whitespace.
+        pieces = line.split(maxsplit=3)
+        if pieces[0] not in XMP_TAGS: continue
+
+        k = XMP_TAGS[pieces[0]]
+        value = pieces[3] if len(pieces) > 3 else ""
+
+        if k in ["title", "description"] and value.startswith("lang="):
+            # Strip the language qualifier.
+            value = value.partition(" ")[2]
+        elif k == "date_time":
+            value = _parse_xmp_date(value, default_time_zone=default_time_zone)
+        elif k == "tags":
             value = [x.strip() for x in value.split(",")]
-        else:
-            continue
 
         data[k] = value
 
     return data
 
-def write_xmp_to_file(file_name, metadata, language, ignore_errors=False):
-    """Writes the metadata entries as XMP tags tothe given file."""
+def _jpeg_segments(f):
+    """Generates triples (marker, offset, length) of the segments before the
+    image data of the given open JPEG file. The offset and length refer to the
+    segment payload. Only the segment headers are read."""
+
+    f.seek(2)
+    while True:
+        marker = f.read(2)
+        if len(marker) < 2 or marker[0] != 0xFF:
+            return
+        # Skip fill bytes.
+        while marker[1] == 0xFF:
+            marker = marker[1:] + f.read(1)
+        # Start of scan and end of image: no metadata follows.
+        if marker[1] in [0xDA, 0xD9]:
+            return
+        # Standalone markers have no length.
+        if marker[1] == 0x01 or 0xD0 <= marker[1] <= 0xD7:
+            continue
+
+        length = struct.unpack(">H", f.read(2))[0]
+        offset = f.tell()
+        yield marker[1], offset, length - 2
+        f.seek(offset + length - 2)
+
+def _png_chunks(f):
+    """Generates triples (type, offset, length) of the chunks of the given open
+    PNG file. The offset and length refer to the chunk data. The data itself is
+    skipped without reading."""
+
+    f.seek(8)
+    while True:
+        header = f.read(8)
+        if len(header) < 8:
+            return
+        length, chunk_type = struct.unpack(">I4s", header)
+        if chunk_type == b"IEND":
+            return
+
+        offset = f.tell()
+        yield chunk_type, offset, length
+        # Skip the data and CRC.
+        f.seek(offset + length + 4)
+
+def _find_jpeg_xmp_packet(f):
+    """Returns the pair (offset, length) of the XMP packet in the given open
+    JPEG file or None if the file has no XMP packet."""
+
+    signature = b"http://ns.adobe.com/xap/1.0/\x00"
+
+    for marker, offset, length in _jpeg_segments(f):
+        if marker != 0xE1 or length < len(signature): continue
+        f.seek(offset)
+        if f.read(len(signature)) == signature:
+            return offset + len(signature), length - len(signature)
+
+    return None
+
+def _read_jpeg_xmp_packet(f):
+    """Returns the XMP packet of the given open JPEG file or None if the file
+    has no XMP packet."""
+
+    location = _find_jpeg_xmp_packet(f)
+    if location is None:
+        return None
+
+    offset, length = location
+    f.seek(offset)
+    return f.read(length)
+
+def _find_png_xmp_chunk(f):
+    """Returns the quadruple (offset, length, start, compressed) for the iTXt
+    chunk containing the XMP packet in the given open PNG file or None if the
+    file has no XMP packet. The offset and length refer to the chunk data, and
+    the packet is the data from start on."""
+
+    keyword = b"XML:com.adobe.xmp"
+
+    for chunk_type, offset, length in _png_chunks(f):
+        if chunk_type != b"iTXt": continue
+        f.seek(offset)
+        data = f.read(length)
+        chunk_keyword, _, rest = data.partition(b"\x00")
+        if chunk_keyword != keyword: continue
+        compressed = rest[0] == 1
+        # Skip the compression flag and method, the language tag, and the
+        # translated keyword.
+        _, _, rest = rest[2:].partition(b"\x00")
+        _, _, text = rest.partition(b"\x00")
+        return offset, length, length - len(text), compressed
+
+    return None
+
+def _read_png_xmp_packet(f):
+    """Returns the XMP packet of the given open PNG file or None if the file
+    has no XMP packet."""
+
+    location = _find_png_xmp_chunk(f)
+    if location is None:
+        return None
+
+    offset, length, start, compressed = location
+    f.seek(offset + start)
+    text = f.read(length - start)
+    return zlib.decompress(text) if compressed else text
+
+def read_xmp_packet(file_name):
+    """Reads the raw XMP packet of a JPEG or PNG file or an XMP sidecar file
+    without calling exiv2. Returns None if the file has no XMP packet. Raises
+    ValueError if the file is not a JPEG, PNG, or XMP file."""
+
+    with open(file_name, "rb") as f:
+        if file_name.lower().endswith(".xmp"):
+            return f.read()
+
+        magic = f.read(8)
+        if magic.startswith(b"\xff\xd8"):
+            return _read_jpeg_xmp_packet(f)
+        elif magic == b"\x89PNG\r\n\x1a\n":
+            return _read_png_xmp_packet(f)
+        else:
+            raise ValueError(f"File '{file_name}' is not a JPEG or PNG file.")
+
+def _xmp_property_values(element):
+    """Returns the values of an XMP property element as a list of (language,
+    value) pairs. The property is either a simple value or an array."""
+
+    for container in element:
+        if container.tag in [f"{{{RDF_NAMESPACE}}}{t}" for t in ["Seq", "Bag", "Alt"]]:
+            return [(li.get(XML_LANG), li.text or "") for li in container.findall(f"{{{RDF_NAMESPACE}}}li")]
+
+    return [(element.get(XML_LANG), element.text or "")]
+
+def parse_xmp_packet(packet, default_time_zone=None):
+    """Parses the supported metadata entries from the RDF of a raw XMP packet
+    into picture data."""
+
+    data = get_empty_picture_data()
+    if packet is None:
+        return data
+
+    def tag_name(qualified_name):
+        namespace, _, name = qualified_name[1:].partition("}")
+        if namespace not in XMP_NAMESPACES:
+            return None
+        return f"Xmp.{XMP_NAMESPACES[namespace]}.{name}"
+
+    root = ElementTree.fromstring(packet.strip(b"\x00"))
+    for description in root.iter(f"{{{RDF_NAMESPACE}}}Description"):
+        # Simple properties can be given as attributes.
+        properties = [(tag_name(name), [(None, value)]) for name, value in description.attrib.items()]
+        properties += [(tag_name(element.tag), _xmp_property_values(element)) for element in description]
+        for name, values in properties:
+            if name not in XMP_TAGS or len(values) == 0: continue
+
+            k = XMP_TAGS[name]
+            if k in ["title", "description"]:
+                # Prefer the default language.
+                default = [value for language, value in values if language == "x-default"]
+                value = default[0] if len(default) > 0 else values[0][1]
+            elif k == "author":
+                value = ", ".join(value for _, value in values)
+            elif k == "date_time":
+                value = _parse_xmp_date(values[0][1].strip(), default_time_zone=default_time_zone)
+            elif k == "tags":
+                value = [value.strip() for _, value in values]
+            else:
+                value = values[0][1]
+
+            data[k] = value
+
+    return data
+
+def _parse_exif_lines(lines, tags):
+    """Parses the lines printed by 'exiv2 -pe' for a single file into a
+    dictionary of the specified EXIF tags."""
+
+    tags = [t.lower() for t in tags]
+
+    out = {}
+    for line in lines:
+        pcs = line.split(" ")
+        parts = []
+        i = -1
+        for i, p in enumerate(pcs):
+            if len(p) > 0:
+                parts.append(p)
+            if len(parts) >= 3: break
+
+        parts.append(" ".join(pcs[i+1:])[1:])
+
+        if parts[0].lower() in tags:
+            out[parts[0]] = parts[-1]
+
+    return out
+
+def _print_files(file_names, option, error_class, keys=None, ignore_errors=False):
+    """Runs an exiv2 print call with the given print option on the given files
+    in batches and returns the output lines per file. If keys are given, exiv2
+    only reports the metadata for these keys."""
+
+    for file_name in file_names:
+        if not os.path.exists(file_name):
+            raise IOError(f"File '{file_name}' does not exist.")
+
+    key_filter = []
+    for key in keys if keys is not None else []:
+        key_filter.append("-K")
+        key_filter.append(key)
+
+    lines = {}
+    for batch in _batches(file_names):
+        result = Popen(["exiv2", option, *key_filter, "pr", *batch], stdout=PIPE, stderr=PIPE).communicate()
+        if len(result[1]) > 0 and not ignore_errors:
+            raise error_class(", ".join(batch), result[1].decode("utf-8"))
+
+        lines.update(_split_exiv2_output(batch, result[0]))
+
+    return lines
+
+def load_xmp_from_file(file_name, default_time_zone=None, ignore_errors=False, sidecar_extensions=None):
+    """Loads XMP metadata entries from the given file. If flag ignore_errors is
+    true, then attempt to fetch the metadata even in presence of some errors
+    from the exiv2 tool. The metadata of files with extensions in
+    sidecar_extensions is loaded from their XMP sidecar files if they
+    exist."""
+
+    return load_xmp_from_files([file_name], default_time_zone=default_time_zone, ignore_errors=ignore_errors, sidecar_extensions=sidecar_extensions)[file_name]
+
+def load_xmp_from_files(file_names, default_time_zone=None, ignore_errors=False, sidecar_extensions=None):
+    """Loads XMP metadata entries from the given files using as few exiv2 calls
+    as possible. The output is a dictionary with the file names as keys and
+    the corresponding metadata as values."""
+
+    result = load_metadata_from_files(file_names, default_time_zone=default_time_zone, ignore_errors=ignore_errors, sidecar_extensions=sidecar_extensions)
+    return {file_name: metadata for file_name, (metadata, _) in result.items()}
+
+def _load_xmp_natively(file_name, default_time_zone=None, ignore_errors=False):
+    """Loads XMP metadata entries from the given JPEG, PNG, or XMP sidecar
+    file without calling exiv2. Raises ValueError if the file type is not
+    supported."""
+
+    try:
+        packet = read_xmp_packet(file_name)
+        return parse_xmp_packet(packet, default_time_zone=default_time_zone)
+    except (ElementTree.ParseError, struct.error, zlib.error, IndexError) as exc:
+        if not ignore_errors:
+            raise XMPReadError(file_name, str(exc)) from exc
+        return get_empty_picture_data()
+
+def load_metadata_from_file(file_name, exif_tags=None, default_time_zone=None, ignore_errors=False, sidecar_extensions=None):
+    """Loads the XMP metadata entries and the specified EXIF tags from the
+    given file with at most one exiv2 call. The output is a pair (metadata, EXIF
+    tags) as in load_xmp_from_file and load_exif_from_file."""
+
+    return load_metadata_from_files([file_name], exif_tags=exif_tags, default_time_zone=default_time_zone, ignore_errors=ignore_errors, sidecar_extensions=sidecar_extensions)[file_name]
+
+def _load_metadata_batch(batch, exif_tags, default_time_zone=None, ignore_errors=False, sidecar_extensions=None):
+    """Loads the XMP metadata entries and the specified EXIF tags from a batch
+    of files for load_metadata_from_files."""
+
+    extension = lambda x: x.split(".")[-1].lower() if "." in x else None
+
+    result = {}
+
+    # The XMP packets of JPEG and PNG files and XMP sidecar files are parsed
+    # directly. Other files, and files whose type turns out to be something
+    # else, are handled by exiv2.
+    native = {}
+    for file_name in batch:
+        xmp_file_name = sidecar_file_name(file_name, sidecar_extensions)
+        if xmp_file_name is None or not os.path.exists(xmp_file_name):
+            xmp_file_name = file_name
+            if extension(file_name) not in XMP_NATIVE_EXTENSIONS: continue
+        try:
+            native[file_name] = _load_xmp_natively(xmp_file_name, default_time_zone=default_time_zone, ignore_errors=ignore_errors)
+        except ValueError:
+            pass
+
+    native_files = [file_name for file_name in batch if file_name in native]
+    if len(exif_tags) > 0 and len(native_files) > 0:
+        exif = load_exif_from_files(native_files, exif_tags, ignore_errors=ignore_errors)
+        for file_name in native_files:
+            result[file_name] = (native[file_name], exif[file_name])
+    else:
+        for file_name in native_files:
+            result[file_name] = (native[file_name], {})
+
+    # Both the XMP and EXIF tags are printed by a single call, and exiv2 only
+    # reports the requested keys.
+    exiv2_files = [file_name for file_name in batch if file_name not in native]
+    if len(exiv2_files) > 0:
+        lines = _print_files(exiv2_files, "-pa", XMPReadError, keys=list(XMP_TAGS) + exif_tags, ignore_errors=ignore_errors)
+        for file_name in exiv2_files:
+            xmp_lines = [line for line in lines[file_name] if line.startswith("Xmp.")]
+            exif_lines = [line for line in lines[file_name] if line.startswith("Exif.")]
+            metadata = _parse_xmp_lines(xmp_lines, default_time_zone=default_time_zone)
+            exif = _parse_exif_lines(exif_lines, exif_tags)
+            result[file_name] = (metadata, exif)
+
+    return result
+
+def load_metadata_from_files(file_names, exif_tags=None, default_time_zone=None, ignore_errors=False, callback=None, cancel=None, sidecar_extensions=None, workers=1):
+    """Loads the XMP metadata entries and the specified EXIF tags from the
+    given files. The XMP packets of JPEG and PNG files are read directly, and
+    many files are passed to a single exiv2 call otherwise, so this is much
+    faster than loading the files one by one. The files are split into
+    batches that are loaded by the given number of worker threads. The output
+    is a dictionary with the file names as keys and pairs (metadata, EXIF
+    tags) as values. If callback is given, it is called with the number of
+    files handled so far after each batch (in the calling thread). If cancel
+    (a threading.Event) is given and it is set, the batches not yet started
+    are skipped, and only the files loaded so far are included in the output.
+    The XMP metadata of files with extensions in sidecar_extensions is read
+    from their XMP sidecar files if they exist (and from the files themselves
+    otherwise)."""
+
+    exif_tags = exif_tags if exif_tags is not None else []
+    sidecar_extensions = sidecar_extensions if sidecar_extensions is not None else []
+
+    for file_name in file_names:
+        if not os.path.exists(file_name):
+            raise IOError(f"File '{file_name}' does not exist.")
+
+    # Make sure that all workers get a batch.
+    size = max(1, min(BATCH_SIZE, -(-len(file_names) // workers)))
+
+    result = {}
+    handled = 0
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(_load_metadata_batch, batch, exif_tags, default_time_zone, ignore_errors, sidecar_extensions) for batch in _batches(file_names, size)]
+        for future in as_completed(futures):
+            if future.cancelled(): continue
+            batch_result = future.result()
+            result.update(batch_result)
+
+            handled += len(batch_result)
+            if callback is not None:
+                callback(handled)
+
+            if cancel is not None and cancel.is_set():
+                for f in futures:
+                    f.cancel()
+
+    return result
+
+def _changed_entries(metadata, original):
+    """Returns the names of the metadata entries whose values differ from the
+    original metadata entries."""
+
+    changed = []
+    for entry in metadata:
+        value = metadata[entry]
+        original_value = original[entry]
+        # Date times are equal if they are the same instant, but a change in
+        # the UTC offset must be written.
+        if entry == "date_time":
+            value = value.isoformat() if value is not None else None
+            original_value = original_value.isoformat() if original_value is not None else None
+        if value != original_value:
+            changed.append(entry)
+
+    return changed
+
+def xmp_commands(metadata, language, original=None):
+    """Returns the exiv2 modify commands that write the metadata entries as XMP
+    tags. If the original metadata entries are given, only the changed entries
+    are written, and no commands are returned if nothing has changed."""
+
+    if original is not None:
+        changed = _changed_entries(metadata, original)
+        if len(changed) == 0:
+            return []
+        metadata = {entry: metadata[entry] for entry in changed}
 
     entries = {
         "language": {
@@ -115,9 +594,6 @@ def write_xmp_to_file(file_name, metadata, language, ignore_errors=False):
         metadata[entry] = [metadata[entry]] if metadata[entry] is not None else None
     metadata["language"] = [language]
 
-    if not os.path.exists(file_name):
-        raise IOError(f"File '{file_name}' does not exist.")
-
     # Prepare XMP tag setup.
     # We avoid writing the language tag if it is not needed.
     calls = []
@@ -151,75 +627,439 @@ def write_xmp_to_file(file_name, metadata, language, ignore_errors=False):
         param = f"set {tag_name} {tag_value}"
         calls.append(param)
 
-    # Remove all XMP data from the file.
-    #Popen(["exiv2", "-k", "-dx", "rm", file_name], stdout=PIPE, stderr=PIPE).communicate()
+    return calls
+
+# Guards the namespace prefixes registered in ElementTree by _update_xmp.
+_namespace_lock = threading.Lock()
+
+def _update_xmp(data, metadata, language):
+    """Returns the serialized XMP metadata (without the packet wrapper) of the
+    given raw XMP data with the given metadata entries replaced (entries not in
+    metadata are left as they are). Returns None if the data has no RDF
+    description to update."""
+
+    # Array types of the entries. Other entries are simple values.
+    array_types = {
+        "author":      "Seq",
+        "title":       "Alt",
+        "description": "Alt",
+        "tags":        "Bag",
+    }
+
+    # Keep the namespace prefixes used in the data. The namespaces of the
+    # supported tags get their usual prefixes if they are not used yet.
+    prefixes = [("dc", "http://purl.org/dc/elements/1.1/"), ("Iptc4xmpExt", "http://iptc.org/std/Iptc4xmpExt/2008-02-29/")]
+    for _, (prefix, uri) in ElementTree.iterparse(io.BytesIO(data), events=["start-ns"]):
+        if len(prefix) == 0: continue
+        prefixes.append((prefix, uri))
+
+    root = ElementTree.fromstring(data)
+    descriptions = list(root.iter(f"{{{RDF_NAMESPACE}}}Description"))
+    if len(descriptions) == 0:
+        return None
+
+    namespaces = {prefix: namespace for namespace, prefix in XMP_NAMESPACES.items()}
+    def qualified_name(key):
+        _, prefix, name = key.split(".")
+        return f"{{{namespaces[prefix]}}}{name}"
+
+    # Remove the existing tags. The language tag is always removed as when
+    # writing with exiv2.
+    keys = [key for key, entry in XMP_TAGS.items() if entry in metadata] + ["Xmp.dc.language"]
+    for key in keys:
+        name = qualified_name(key)
+        for description in descriptions:
+            for element in description.findall(name):
+                description.remove(element)
+            description.attrib.pop(name, None)
+
+    # Add the new tags.
+    for key, entry in XMP_TAGS.items():
+        if entry not in metadata or metadata[entry] is None: continue
+
+        element = ElementTree.SubElement(descriptions[0], qualified_name(key))
+        if entry == "date_time":
+            element.text = metadata[entry].isoformat()
+        elif entry in array_types:
+            container = ElementTree.SubElement(element, f"{{{RDF_NAMESPACE}}}{array_types[entry]}")
+            values = metadata[entry] if entry == "tags" else [metadata[entry]]
+            for value in values:
+                li = ElementTree.SubElement(container, f"{{{RDF_NAMESPACE}}}li")
+                li.text = value
+                if array_types[entry] == "Alt":
+                    li.set(XML_LANG, language)
+        else:
+            element.text = metadata[entry]
+
+    # The prefixes are registered globally, so registering them and
+    # serializing must not be interleaved with other threads.
+    with _namespace_lock:
+        for prefix, uri in prefixes:
+            try:
+                ElementTree.register_namespace(prefix, uri)
+            except ValueError:
+                pass
+        return ElementTree.tostring(root, encoding="unicode").encode("utf-8")
+
+def _update_xmp_packet(packet, metadata, language):
+    """Returns the given raw XMP packet with the given metadata entries
+    replaced as in _update_xmp. The new packet has the same length as the
+    original packet; only the amount of padding changes. Returns None if this
+    is not possible, that is, if the packet is not writable or the new packet
+    does not fit."""
+
+    begin = packet.find(b"<?xpacket begin=")
+    end = packet.rfind(b"<?xpacket end=")
+    if begin < 0 or end < begin:
+        return None
+    head = packet[:packet.find(b"?>", begin) + 2]
+    trailer = packet[end:]
+    # The packet can be modified in place only if it is marked writable.
+    if not trailer[len(b"<?xpacket end="):].startswith((b'"w"', b"'w'")):
+        return None
+
+    xmp = _update_xmp(packet[len(head):end], metadata, language)
+    if xmp is None:
+        return None
+
+    content = head + b"\n" + xmp + b"\n"
+    size = len(packet) - len(content) - len(trailer)
+    if size < 0:
+        return None
+
+    # The padding consists of lines of spaces.
+    padding = (b" "*99 + b"\n")*(size // 100) + b" "*(size % 100)
+    return content + padding + trailer
+
+def write_xmp_in_place(file_name, metadata, language, original=None):
+    """Attempts to write the metadata entries as XMP tags to the given JPEG or
+    PNG file by overwriting its existing XMP packet in place. This is possible
+    only if the new packet fits in the padding of the existing packet, and
+    then only the bytes of the packet (and the chunk checksum of a PNG file)
+    are written. Returns True on success and False if the file needs to be
+    written in full instead. If the original metadata entries are given, only
+    the changed entries are written."""
+
+    if original is not None:
+        metadata = {entry: metadata[entry] for entry in _changed_entries(metadata, original)}
+
+    with open(file_name, "rb") as f:
+        magic = f.read(8)
+        if magic.startswith(b"\xff\xd8"):
+            location = _find_jpeg_xmp_packet(f)
+            if location is None:
+                return False
+            offset, length = location
+            f.seek(offset)
+            packet = f.read(length)
+            checksum_offset = None
+        elif magic == b"\x89PNG\r\n\x1a\n":
+            location = _find_png_xmp_chunk(f)
+            if location is None or location[3]:
+                return False
+            chunk_offset, chunk_length, start, _ = location
+            f.seek(chunk_offset)
+            data = f.read(chunk_length)
+            offset = chunk_offset + start
+            packet = data[start:]
+            checksum_offset = chunk_offset + chunk_length
+        else:
+            return False
+
+    try:
+        new_packet = _update_xmp_packet(packet, metadata, language)
+    except ElementTree.ParseError:
+        return False
+    if new_packet is None:
+        return False
+
+    fd = os.open(file_name, os.O_WRONLY)
+    try:
+        os.pwrite(fd, new_packet, offset)
+        if checksum_offset is not None:
+            # The CRC covers the chunk type and data.
+            crc = zlib.crc32(b"iTXt" + data[:start] + new_packet)
+            os.pwrite(fd, struct.pack(">I", crc), checksum_offset)
+    finally:
+        os.close(fd)
 
-    # Prepare the call for adding the metadata.
-    call = ["exiv2", "-k"]
-    for c in calls:
-        call.append("-M")
-        call.append(c)
-    call.append(file_name)
+    return True
 
-    # Perform the call.
-    result = Popen(call, stdout=PIPE, stderr=PIPE).communicate()
-    if len(result[1]) > 0 and not ignore_errors:
-        raise XMPWriteError(file_name, result[1].decode("utf-8"))
+def sidecar_file_name(file_name, sidecar_extensions):
+    """Returns the name of the XMP sidecar file of the given file if files with
+    its extension keep their XMP metadata in sidecar files. Otherwise returns
+    None. The sidecar of a file is the file name followed by '.xmp'."""
+
+    extension = file_name.split(".")[-1].lower() if "." in file_name else None
+    if extension is None or extension not in sidecar_extensions:
+        return None
+
+    return file_name + ".xmp"
+
+def file_stat(file_name, sidecar_extensions):
+    """Returns the size and modification time (in nanoseconds) of the given
+    file followed by the size and modification time of its XMP sidecar or
+    None if the file does not exist. The sidecar values are None if the file
+    has no sidecar."""
+
+    try:
+        st = os.stat(file_name)
+    except OSError:
+        return None
+
+    sidecar = sidecar_file_name(file_name, sidecar_extensions)
+    try:
+        sidecar_st = os.stat(sidecar) if sidecar is not None else None
+    except OSError:
+        sidecar_st = None
+    if sidecar_st is None:
+        return st.st_size, st.st_mtime_ns, None, None
+
+    return st.st_size, st.st_mtime_ns, sidecar_st.st_size, sidecar_st.st_mtime_ns
+
+def write_xmp_sidecar(sidecar, metadata, language, original=None):
+    """Writes the metadata entries as XMP tags to the given XMP sidecar file.
+    The other tags of an existing sidecar are kept, and a new sidecar is
+    created otherwise. If the original metadata entries are given, only the
+    changed entries are written."""
+
+    if original is not None:
+        metadata = {entry: metadata[entry] for entry in _changed_entries(metadata, original)}
+
+    if os.path.exists(sidecar):
+        with open(sidecar, "rb") as f:
+            data = f.read()
+    else:
+        data = f'<x:xmpmeta xmlns:x="adobe:ns:meta/"><rdf:RDF xmlns:rdf="{RDF_NAMESPACE}"><rdf:Description rdf:about=""/></rdf:RDF></x:xmpmeta>'.encode("utf-8")
+
+    try:
+        xmp = _update_xmp(data, metadata, language)
+    except ElementTree.ParseError as exc:
+        raise XMPWriteError(sidecar, str(exc)) from exc
+    if xmp is None:
+        raise XMPWriteError(sidecar, "No RDF description found.")
+
+    # Write a temporary file first so that the sidecar is never left half
+    # written. The temporary file is only readable by the owner, so it gets
+    # the mode of the existing sidecar or the usual mode of a new file.
+    try:
+        mode = stat.S_IMODE(os.stat(sidecar).st_mode)
+    except FileNotFoundError:
+        mode = 0o644
+    packet = '<?xpacket begin="\ufeff" id="W5M0MpCehiHzreSzNTczkc9d"?>\n'.encode("utf-8") + xmp + b'\n<?xpacket end="w"?>'
+    fd, tmp_file_name = tempfile.mkstemp(prefix=".arris-", suffix=".xmp", dir=os.path.dirname(sidecar))
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(packet)
+        os.chmod(tmp_file_name, mode)
+        os.replace(tmp_file_name, sidecar)
+    except BaseException:
+        if os.path.exists(tmp_file_name):
+            os.remove(tmp_file_name)
+        raise
+
+def apply_commands_to_file(file_name, commands, error_class):
+    """Applies the given exiv2 modify commands to the given file in a single
+    exiv2 call. The commands are written to a command file to avoid long
+    argument lists. The given error class is raised if exiv2 fails; warnings
+    (output with a zero exit status) are ignored."""
+
+    if not os.path.exists(file_name):
+        raise IOError(f"File '{file_name}' does not exist.")
+    if len(commands) == 0:
+        return
+
+    # A command file cannot contain values with line breaks, so then we pass
+    # the commands as arguments.
+    if any("\n" in c or "\r" in c for c in commands):
+        call = ["exiv2", "-k"]
+        for c in commands:
+            call.append("-M")
+            call.append(c)
+        command_file_name = None
+    else:
+        fd, command_file_name = tempfile.mkstemp(suffix=".txt", text=True)
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            for c in commands:
+                f.write(c + "\n")
+        call = ["exiv2", "-k", "-m", command_file_name]
+
+    try:
+        process = Popen(call + [file_name], stdout=PIPE, stderr=PIPE)
+        _, stderr = process.communicate()
+        if process.returncode != 0:
+            raise error_class(file_name, stderr.decode("utf-8", errors="replace").strip() or f"exiv2 exited with code {process.returncode}.")
+    finally:
+        if command_file_name is not None:
+            os.remove(command_file_name)
+
+def _read_ifd(f, base, offset, byte_order):
+    """Reads the entries of the TIFF image file directory at the given offset
+    (relative to the TIFF header at base). Returns a dictionary with the tag
+    numbers as keys and triples (type, count, value field) as values."""
+
+    f.seek(base + offset)
+    count = struct.unpack(byte_order + "H", f.read(2))[0]
+    data = f.read(12*count)
+
+    entries = {}
+    for n in range(count):
+        tag, value_type, value_count = struct.unpack(byte_order + "HHI", data[12*n:12*n + 8])
+        entries[tag] = (value_type, value_count, data[12*n + 8:12*n + 12])
+
+    return entries
+
+def _ifd_value(f, base, byte_order, entry):
+    """Returns the value of the given IFD entry as a string in the format
+    exiv2 uses for plain values. Only the ASCII, BYTE, SHORT, and LONG types
+    are supported; other types yield None."""
+
+    value_type, count, field = entry
+    sizes = {1: 1, 2: 1, 3: 2, 4: 4}
+    if value_type not in sizes:
+        return None
+
+    size = sizes[value_type]*count
+    if size > 4:
+        f.seek(base + struct.unpack(byte_order + "I", field)[0])
+        data = f.read(size)
+    else:
+        data = field[:size]
+
+    if value_type == 2:
+        return data.split(b"\x00")[0].decode("utf-8", errors="replace").strip()
+
+    fmt = {1: "B", 3: "H", 4: "I"}[value_type]
+    values = struct.unpack(f"{byte_order}{count}{fmt}", data)
+    return " ".join(str(v) for v in values)
+
+def _read_tiff_tags(f, base, tags):
+    """Reads the given EXIF tags from the TIFF structure whose header begins at
+    offset base of the given open file. Only the directories containing the
+    requested tags are visited."""
+
+    f.seek(base)
+    header = f.read(8)
+    if header[:2] not in [b"II", b"MM"]:
+        raise ValueError("Invalid TIFF byte order.")
+    byte_order = "<" if header[:2] == b"II" else ">"
+    # TIFF and CR2 use the magic number 42, RW2 uses 0x55.
+    magic, ifd0_offset = struct.unpack(byte_order + "HI", header[2:8])
+    if magic not in [42, 0x55]:
+        raise ValueError(f"Unknown TIFF magic number {magic}.")
+
+    out = {}
+    ifds = {"Image": _read_ifd(f, base, ifd0_offset, byte_order)}
+    for tag in tags:
+        group, number = EXIF_NATIVE_TAGS[tag]
+        if group not in ifds:
+            # The group is a subdirectory pointed to by an IFD0 entry.
+            pointer = ifds["Image"].get(EXIF_NATIVE_GROUPS[group])
+            ifds[group] = _read_ifd(f, base, struct.unpack(byte_order + "I", pointer[2])[0], byte_order) if pointer is not None else {}
+        if number in ifds[group]:
+            value = _ifd_value(f, base, byte_order, ifds[group][number])
+            if value is not None:
+                out[tag] = value
+
+    return out
+
+def read_exif_tags(file_name, tags):
+    """Reads the given EXIF tags from a JPEG, PNG, CR2, or RW2 file without
+    calling exiv2. Only the tags in EXIF_NATIVE_TAGS are supported. The output
+    is as in load_exif_from_file except that all values are plain (e.g., the
+    orientation is a number). Raises ValueError if the file type is not
+    supported."""
+
+    with open(file_name, "rb") as f:
+        magic = f.read(8)
+        if magic.startswith(b"\xff\xd8"):
+            signature = b"Exif\x00\x00"
+            for marker, offset, length in _jpeg_segments(f):
+                if marker != 0xE1: continue
+                f.seek(offset)
+                if f.read(len(signature)) == signature:
+                    return _read_tiff_tags(f, offset + len(signature), tags)
+            return {}
+        elif magic == b"\x89PNG\r\n\x1a\n":
+            for chunk_type, offset, _ in _png_chunks(f):
+                if chunk_type == b"eXIf":
+                    return _read_tiff_tags(f, offset, tags)
+            return {}
+        elif magic[:2] in [b"II", b"MM"]:
+            # CR2 and RW2 files are TIFF containers.
+            return _read_tiff_tags(f, 0, tags)
+        else:
+            raise ValueError(f"File '{file_name}' is not a JPEG, PNG, or TIFF-based file.")
 
 def load_exif_from_file(file_name, tags, ignore_errors=False):
     """Load the specified EXIF tags from the specified file. The output is a
     dictionary with the tags as keys and the corresponding values as strings.
     If a specified tag is not a key, then the EXIF tag does not exist."""
 
-    tags = [t.lower() for t in tags]
+    return load_exif_from_files([file_name], tags, ignore_errors=ignore_errors)[file_name]
 
-    if not os.path.exists(file_name):
-        raise IOError(f"File '{file_name}' does not exist.")
+def load_exif_from_files(file_names, tags, ignore_errors=False):
+    """Load the specified EXIF tags from the given files using as few exiv2
+    calls as possible. The output is a dictionary with the file names as keys
+    and the dictionaries of load_exif_from_file as values.
+
+    The tags in EXIF_NATIVE_TAGS are read directly from the files. Exiv2 is
+    called only for files of other types and for files that need other tags.
+    Maker note tags are only needed if the camera make matches."""
+
+    for file_name in file_names:
+        if not os.path.exists(file_name):
+            raise IOError(f"File '{file_name}' does not exist.")
+
+    extension = lambda x: x.split(".")[-1].lower() if "." in x else None
 
-    result = Popen(["exiv2", "-pe", "pr", file_name], stdout=PIPE, stderr=PIPE).communicate()
-    if len(result[1]) > 0 and not ignore_errors:
-        raise EXIFReadError(file_name, result[1].decode("utf-8"))
+    native_tags = [tag for tag in tags if tag in EXIF_NATIVE_TAGS]
+    other_tags = [tag for tag in tags if tag not in EXIF_NATIVE_TAGS]
+    maker_note_tags = [tag for tag in other_tags if tag in EXIF_MAKER_NOTE_TAGS]
+    read_tags = native_tags + (["Exif.Image.Make"] if len(maker_note_tags) > 0 and "Exif.Image.Make" not in native_tags else [])
 
     out = {}
-    for line in result[0].splitlines():
-        line = line.decode("utf-8")
-        pcs = line.split(" ")
-        parts = []
-        i = -1
-        for i, p in enumerate(pcs):
-            if len(p) > 0:
-                parts.append(p)
-            if len(parts) >= 3: break
+    exiv2_files = []
+    for file_name in file_names:
+        if extension(file_name) not in EXIF_NATIVE_EXTENSIONS:
+            exiv2_files.append(file_name)
+            continue
 
-        parts.append(" ".join(pcs[i+1:])[1:])
+        try:
+            exif = read_exif_tags(file_name, read_tags)
+        except (ValueError, struct.error):
+            exiv2_files.append(file_name)
+            continue
 
-        if parts[0].lower() in tags:
-            out[parts[0]] = parts[-1]
+        make = exif.get("Exif.Image.Make", "").upper()
+        if "Exif.Image.Make" not in native_tags:
+            exif.pop("Exif.Image.Make", None)
+        needed = [tag for tag in other_tags if tag not in EXIF_MAKER_NOTE_TAGS or make.startswith(EXIF_MAKER_NOTE_TAGS[tag])]
+        if len(needed) > 0:
+            exiv2_files.append(file_name)
+        else:
+            out[file_name] = exif
 
-    return out
+    if len(exiv2_files) > 0:
+        lines = _print_files(exiv2_files, "-pe", EXIFReadError, keys=tags, ignore_errors=ignore_errors)
+        for file_name in exiv2_files:
+            out[file_name] = _parse_exif_lines(lines[file_name], tags)
 
-def write_exif_to_file(file_name, tags):
-    """Sets the EXIF tags of the specified file according to the given
-    dictionary (tag-value pairs)."""
+    return out
 
-    if not os.path.exists(file_name):
-        raise IOError(f"File '{file_name}' does not exist.")
+def exif_commands(tags):
+    """Returns the exiv2 modify commands that set the EXIF tags according to
+    the given dictionary (tag-value pairs). The value None deletes the tag."""
 
-    # Prepare the EXIF tag setup.
-    call = ["exiv2", "-k"]
+    calls = []
     for tag, value in tags.items():
-        call.append("-M")
         if value is not None:
             param = f"set {tag} {value}"
         else:
             param = f"del {tag}"
-        call.append(param)
-    call.append(file_name)
+        calls.append(param)
 
-    # Perform the call.
-    result = Popen(call, stdout=PIPE, stderr=PIPE).communicate()
-    if len(result[1]) > 0:
-        raise EXIFWriteError(file_name, result[1].decode("utf-8"))
+    return calls
 
 def exif_timestamp_to_datetime(timestamp, time_zone=None):
     """Converts an EXIF timestamp of the format 'YYYY:MM:DD HH:MM:SS' to a
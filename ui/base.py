@@ -1,13 +1,14 @@
 import os, datetime
 
-from PySide6.QtCore import QCoreApplication, Qt, QDir, QTimer
-from PySide6.QtWidgets import QAbstractItemView, QFileSystemModel, QGridLayout, QLabel, QListWidgetItem, QMessageBox, QProgressBar, QSizePolicy, QStyle, QSpacerItem, QVBoxLayout, QWidget
+from PySide6.QtCore import Qt, QDir, QThreadPool, QTimer
+from PySide6.QtGui import QPixmap
+from PySide6.QtWidgets import QAbstractItemView, QFileSystemModel, QGridLayout, QLabel, QLineEdit, QListWidgetItem, QMessageBox, QProgressBar, QPushButton, QSizePolicy, QStyle, QSpacerItem, QVBoxLayout, QWidget
 
 from ui.tag_adder import TagAdder
 from ui.thumbnail_loader import ThumbnailLoader
 from ui.time_adjuster import TimeAdjuster
 
-from util import items, setup_separator_completer, datetime_to_qdatetime
+from util import setup_separator_completer, datetime_to_qdatetime
 from picture_metadata import get_empty_picture_data
 
 class Base_MainWindow:
@@ -23,6 +24,7 @@ class Base_MainWindow:
 
     THUMBNAIL_WIDTH = 200 # Width for thumbnails (we preserve aspect ratio).
     PREVIEW_COLUMNS = 2   # Into how many columns the thumbnails are put.
+    PREFETCH_COUNT = 3    # How many files ahead of a single selected file are prefetched.
 
     ACCURACY = 2 # Number of digits for fractional UTC offsets.
 
@@ -68,6 +70,17 @@ class Base_MainWindow:
         self.disabled_selection_changed_signals = CtxSelectionChanged(self)
         self.disabled_edit_signals = CtxMetadataSignals(self)
 
+        # The path the listed files are relative to, the list widget items by
+        # their indices, and the indices of the edited and deleted items.
+        self.list_path = ""
+        self.list_items = {}
+        self.edited_items = set()
+        self.deleted_items = set()
+
+        # For prefetching the neighbors of a single selected file.
+        self.prefetch_row = None
+        self.prefetch_loaders = []
+
     def _setup_widgets(self, default_path=None):
         self._setup_toolbar()
         self._setup_statusbar()
@@ -105,11 +118,27 @@ class Base_MainWindow:
         self.actionSave.setIcon(icon)
         self.actionSave.setEnabled(False)
 
+        # Search box for searching the metadata catalog. Searching is not
+        # possible without the catalog.
+        self.search_lineEdit = QLineEdit()
+        self.search_lineEdit.setPlaceholderText("Search titles, descriptions, tags, places, authors")
+        self.search_lineEdit.setClearButtonEnabled(True)
+        self.search_lineEdit.setMaximumWidth(400)
+        self.toolBar.addSeparator()
+        self.toolBar.addWidget(self.search_lineEdit)
+        self.search_lineEdit.setEnabled(len(self.config.general.catalog) > 0)
+
     def _setup_statusbar(self):
         self.progress_bar = QProgressBar()
         self.statusbar.addPermanentWidget(self.progress_bar)
         self.progress_bar.setVisible(False)
         self.progress_value = 0
+        self.in_progress = False
+
+        # Button for cancelling long operations.
+        self.cancel_button = QPushButton("Cancel")
+        self.statusbar.addPermanentWidget(self.cancel_button)
+        self.cancel_button.setVisible(False)
 
     def _setup_filesystem_treeView(self, default_path):
         # Set up file system model.
@@ -170,8 +199,15 @@ class Base_MainWindow:
         self.image_container.setLayout(self.grid_layout)
         self.image_container_scrollArea.setEnabled(False)
 
+        # The thumbnails are decoded in parallel by a pool of worker threads
+        # shared by all thumbnail loaders.
+        self.thumbnail_pool = QThreadPool(self)
+        self.thumbnail_pool.setMaxThreadCount(self.config.general.workers)
+
     def _setup_signals_context(self):
         # State changes.
+        self.context.enter_edited.connect(self.enter_edited)
+        self.context.enter_not_edited.connect(self.enter_not_edited)
         self.context.enter_initial.connect(self.enter_initial)
         self.context.edit_zero_files.connect(self.enter_edit_zero_files)
         self.context.edit_one_file.connect(self.enter_edit_one_file)
@@ -179,12 +215,20 @@ class Base_MainWindow:
 
         # Other.
         self.context.update_files.connect(self.populate_listWidget)
+        self.context.append_files.connect(self.append_listWidget)
+        self.context.files_listed.connect(self.finish_progress)
         self.context.files_not_updated.connect(self.restore_selection)
+        self.context.files_not_updated.connect(self.finish_progress)
+        self.context.listing_failed.connect(self.report_listing_failure)
         self.context.ask_discard_changes.connect(self.ask_discard_changes)
         self.context.update_metadata.connect(self.populate_metadata_entries)
         self.context.file_deleted.connect(self.remove_listWidget)
+        self.context.files_changed.connect(self.invalidate_thumbnails)
         self.context.rename_files.connect(self.rename_files)
         self.context.indicate_progress.connect(self.indicate_progress)
+        self.context.progress_maximum.connect(self.set_progress_maximum)
+        self.context.operation_cancelled.connect(self.finish_progress)
+        self.context.save_failed.connect(self.report_save_failure)
 
     def _setup_signals_ui(self):
         self.filesystem_treeView.clicked.connect(self.on_directory_clicked)
@@ -196,6 +240,8 @@ class Base_MainWindow:
         self.tagadder_button.clicked.connect(self.open_tag_adder)
         self.adjust_time_button.clicked.connect(self.open_time_adjuster)
         self.actionSave.triggered.connect(self.on_save)
+        self.cancel_button.clicked.connect(self.on_cancel)
+        self.search_lineEdit.returnPressed.connect(self.on_search)
 
     def _setup_signals_metadata(self):
         entries = {
@@ -262,21 +308,67 @@ class Base_MainWindow:
         if self.thumbnail_loader_thread is not None and not self.thumbnail_loader_thread.isFinished():
             self.thumbnail_loader_thread.stop()
 
-        self.thumbnail_loader_thread = ThumbnailLoader(files, width=self.THUMBNAIL_WIDTH)
-        self.thumbnail_loader_thread.thumbnail_loaded.connect(self.display_thumbnail)
+        self.thumbnail_loader_thread = ThumbnailLoader(files, width=self.THUMBNAIL_WIDTH, pool=self.thumbnail_pool)
+        self.thumbnail_loader_thread.thumbnails_loaded.connect(self.display_thumbnails)
 
         self.thumbnail_loader_thread.start()
 
+    def prefetch_neighbors(self, item):
+        """Prefetches the metadata and thumbnails of the files following the
+        given single selected list widget item in the direction in which the
+        selection moves. The file in the opposite direction is prefetched
+        too."""
+
+        row = self.files_listWidget.row(item)
+        direction = -1 if self.prefetch_row is not None and row < self.prefetch_row else 1
+        self.prefetch_row = row
+
+        rows = [row + direction*k for k in range(1, self.PREFETCH_COUNT + 1)] + [row - direction]
+        items = [self.files_listWidget.item(r) for r in rows if 0 <= r < self.files_listWidget.count()]
+        # Skip deleted files.
+        items = [x for x in items if x.flags() & Qt.ItemIsEnabled == Qt.ItemIsEnabled]
+
+        # The metadata is loaded by the controller.
+        self.context.request_prefetch.emit([x.data(self.OFFSET_IDX) for x in items])
+
+        # Stop loading the thumbnails of the previous neighbors. We do not wait
+        # for the loaders to finish but keep them until they do. The
+        # thumbnails they still deliver are stored.
+        for loader in self.prefetch_loaders:
+            loader.stop(wait=False)
+        self.prefetch_loaders = [loader for loader in self.prefetch_loaders if not loader.isFinished()]
+
+        not_loaded = [(n, x.data(self.OFFSET_IDX), x.data(self.OFFSET_PATH)) for n, x in enumerate(items) if x.data(self.OFFSET_THUMBNAIL) is None]
+        if len(not_loaded) == 0: return
+
+        loader = ThumbnailLoader(not_loaded, width=self.THUMBNAIL_WIDTH, pool=self.thumbnail_pool)
+        loader.thumbnails_loaded.connect(self.store_thumbnails)
+        loader.start()
+        self.prefetch_loaders.append(loader)
+
+    def store_thumbnails(self, thumbnails):
+        """Stores the given batch of prefetched thumbnails to their list
+        widget items."""
+
+        for _, list_idx, thumbnail in thumbnails:
+            item = self.list_items.get(list_idx)
+            if item is not None and item.data(self.OFFSET_THUMBNAIL) is None:
+                item.setData(self.OFFSET_THUMBNAIL, QPixmap.fromImage(thumbnail))
+
+    def display_thumbnails(self, thumbnails):
+        """Displays the given batch of loaded thumbnails. The thumbnail grid is
+        redrawn once for the whole batch."""
+
+        self.image_container.setUpdatesEnabled(False)
+        for grid_idx, list_idx, thumbnail in thumbnails:
+            self.display_thumbnail(grid_idx, list_idx, QPixmap.fromImage(thumbnail))
+        self.image_container.setUpdatesEnabled(True)
+
     def display_thumbnail(self, grid_idx, list_idx, thumbnail):
         width = self.THUMBNAIL_WIDTH + 10
 
-        selected, _ = self.get_selected_idx()
-        item = None
-        for x in selected:
-            if x.data(self.OFFSET_IDX) == list_idx:
-                item = x
-                break
-        if item is None:
+        item = self.list_items.get(list_idx)
+        if item is None or not item.isSelected():
             # This can happen if the user changes the selection while the
             # thumbnails are being loaded.
             return
@@ -315,32 +407,71 @@ class Base_MainWindow:
         # Signals for clicking.
         image_label.mousePressEvent = lambda event, item=item: self.on_thumbnail_clicked(event, item.data(self.OFFSET_PATH), rotation_angle=item.data(self.OFFSET_ROTATE))
 
-    def setup_progress_bar(self, maximum):
+    def set_busy(self, busy):
+        """Disables or enables all elements except the status bar."""
+
+        self.centralwidget.setEnabled(not busy)
+        self.toolBar.setEnabled(not busy)
+        self.menubar.setEnabled(not busy)
+
+    def setup_progress_bar(self, maximum, cancellable=False):
         """Enables the progress bar in the status bar. The maximum is set to
-        the given value, and the current value is set to 0."""
+        the given value, and the current value is set to 0. If the maximum is
+        None, the progress bar only indicates that the operation is running.
+        If cancellable is True, a cancel button is displayed next to the
+        progress bar."""
 
         def disable_with_delay():
-            if self.progress_value < self.progress_bar.maximum():
-                self.setEnabled(False)
+            if self.in_progress:
+                self.set_busy(True)
+                self.cancel_button.setVisible(cancellable)
 
         self.progress_value = 0
         self.progress_bar.setValue(self.progress_value)
-        self.progress_bar.setMaximum(maximum)
-        if maximum > 0:
+        self.progress_bar.setMaximum(maximum if maximum is not None else 0)
+        if maximum is None or maximum > 0:
+            self.in_progress = True
             self.progress_bar.setVisible(True)
             # We delay setting all elements disabled to avoid flicker when the
             # load is fast.
             QTimer.singleShot(200, disable_with_delay)
 
+    def set_progress_maximum(self, maximum):
+        """Sets the maximum of the progress bar once the length of the
+        operation is known. The maximum 0 means that there is nothing left to
+        do."""
+
+        if maximum == 0:
+            self.finish_progress()
+        else:
+            self.progress_bar.setMaximum(maximum)
+
     def indicate_progress(self, progress):
         """Advances the status bar progress bar to the indicated value."""
 
-        QCoreApplication.processEvents()
         self.progress_value = progress
         self.progress_bar.setValue(self.progress_value)
-        if self.progress_value >= self.progress_bar.maximum():
-            self.progress_bar.setVisible(False)
-            self.setEnabled(True)
+        if self.progress_bar.maximum() > 0 and self.progress_value >= self.progress_bar.maximum():
+            self.finish_progress()
+
+    def finish_progress(self):
+        """Hides the progress bar and enables all elements. This is called
+        when the operation finishes or it is cancelled."""
+
+        # Prevent the delayed disabling in case the operation was fast.
+        self.in_progress = False
+        self.progress_bar.setVisible(False)
+        self.cancel_button.setVisible(False)
+        self.statusbar.clearMessage()
+        self.set_busy(False)
+
+    def submit_metadata(self):
+        """Submits the metadata currently written in the metadata entries to
+        the controller. Nothing is submitted if no file is being edited."""
+
+        if not self.metadata_groupBox.isEnabled(): return
+
+        self.context.submit_metadata.emit(self.get_metadata())
 
     def get_metadata(self):
         """Return the metadata currently written in the metadata entries."""
@@ -397,7 +528,16 @@ class Base_MainWindow:
         """Populate the list widget with the given files."""
 
         self.depopulate_listWidget()
-        for n, f in enumerate(files):
+        self.prefetch_row = None
+        self.list_path = path
+        self.append_listWidget(0, files)
+
+    def append_listWidget(self, first, files):
+        """Appends the given files to the list widget. The first file has the
+        given index, and the rest are numbered consecutively."""
+
+        path = self.list_path
+        for n, f in enumerate(files, start=first):
             item = QListWidgetItem(os.path.relpath(f, path))
             item.setData(self.OFFSET_IDX, n)
             item.setData(self.OFFSET_PATH, f)
@@ -405,6 +545,11 @@ class Base_MainWindow:
             item.setData(self.OFFSET_THUMBNAIL, None)
             item.setData(self.OFFSET_ROTATE, 0)
             self.files_listWidget.addItem(item)
+            self.list_items[n] = item
+
+        # Display a running count while the files are listed.
+        if self.in_progress:
+            self.statusbar.showMessage(f"{len(self.list_items)} files found")
 
     def depopulate_listWidget(self):
         """Depopulates the list widget."""
@@ -414,17 +559,31 @@ class Base_MainWindow:
             self.clear_metadata_entries()
             self.metadata_groupBox.setEnabled(False)
             self.files_listWidget.clear()
+            self.list_items = {}
+            self.edited_items = set()
+            self.deleted_items = set()
 
     def remove_listWidget(self, idx):
         """Removes file with the given index from the list widget."""
 
+        item = self.list_items.pop(idx, None)
+        if item is None: return
+        self.edited_items.discard(idx)
+        self.deleted_items.discard(idx)
+
         with self.disabled_selection_changed_signals:
-            # Remove the file from the list widget.
-            for item in items(self.files_listWidget):
-                if item.data(self.OFFSET_IDX) == idx:
-                    row = self.files_listWidget.row(item)
-                    self.files_listWidget.takeItem(row)
-                    break
+            # Remove the file from the list widget. Finding the row is fast
+            # when the files are removed from the last to the first.
+            self.files_listWidget.takeItem(self.files_listWidget.row(item))
+
+    def invalidate_thumbnails(self, files_idx):
+        """Forgets the loaded thumbnails of the given files, so that they are
+        loaded again when needed."""
+
+        for idx in files_idx:
+            item = self.list_items.get(idx)
+            if item is not None:
+                item.setData(self.OFFSET_THUMBNAIL, None)
 
     def restore_selection(self):
         """Restores the previous filesystem tree view selection in the event
@@ -545,7 +704,7 @@ class Base_MainWindow:
         """Renames the files based on the given data."""
 
         for idx, new_file_name in data:
-            item = self.files_listWidget.item(idx)
+            item = self.list_items[idx]
             current_path = item.data(self.OFFSET_PATH)
             current_relative_path = item.data(self.OFFSET_RELATIVE_PATH)
 
@@ -1,34 +1,104 @@
-from PySide6.QtCore import Qt, QThread, Signal
-from PySide6.QtGui import QPixmap
+import queue, threading, time
 
-from util import load_photo
+from PySide6.QtCore import Qt, QRunnable, QThread, Signal
+from PySide6.QtGui import QImage
+
+from util import load_image
+
+def load_thumbnail(file_name, width):
+    """Loads the given file as a QImage scaled to fit in a square of the given
+    width."""
+
+    image = load_image(file_name)
+    return image.scaled(width, width, Qt.KeepAspectRatio, Qt.SmoothTransformation)
+
+class ThumbnailJob(QRunnable):
+    """A job of a thumbnail pool (a QThreadPool) that loads one thumbnail and
+    puts it with its grid and list indices to the given results queue. The
+    job does nothing if the given threading.Event stopped is set when the job
+    starts. A file that cannot be loaded gets a null thumbnail."""
+
+    def __init__(self, results, stopped, grid_idx, list_idx, file_name, width):
+        super().__init__()
+        self.results = results
+        self.stopped = stopped
+        self.grid_idx = grid_idx
+        self.list_idx = list_idx
+        self.file_name = file_name
+        self.width = width
+
+    def run(self):
+        if self.stopped.is_set(): return
+
+        try:
+            thumbnail = load_thumbnail(self.file_name, self.width)
+        except Exception:
+            thumbnail = QImage()
+        self.results.put((self.grid_idx, self.list_idx, thumbnail))
 
 class ThumbnailLoader(QThread):
-    """A thread for loading thumbnails asynchronously."""
+    """A thread for loading thumbnails asynchronously. The thumbnails are
+    decoded in parallel by the given pool (a QThreadPool) and delivered in the
+    order they finish in batches of triples (grid index, list index,
+    thumbnail), so that the UI is not flooded with signals when loading is
+    fast. The thumbnails are delivered as QImage objects as QPixmap objects
+    cannot be created outside the thread of the UI."""
+
+    # Minimum time in seconds between delivering two batches of thumbnails
+    # (about one frame).
+    DELIVERY_INTERVAL = 0.016
+
+    thumbnails_loaded = Signal(list)
 
-    thumbnail_loaded = Signal(int, int, QPixmap)
-    
-    def __init__(self, files, width):
+    def __init__(self, files, width, pool):
         super().__init__()
         self.files = files
         self.width = width
-        # Flag to control the thread stop.
-        self._stop_requested = False
+        self.pool = pool
+        self.results = queue.Queue()
+        # Flag to control the thread stop. The jobs not yet started in the
+        # pool are skipped once it is set.
+        self.stopped = threading.Event()
 
     def run(self):
         for grid_idx, list_idx, file_name in self.files:
-            if self._stop_requested:
-                break
+            self.pool.start(ThumbnailJob(self.results, self.stopped, grid_idx, list_idx, file_name, self.width))
+
+        batch = []
+        last_delivered = 0
+
+        def deliver():
+            nonlocal batch, last_delivered
+            if len(batch) > 0:
+                self.thumbnails_loaded.emit(batch)
+                batch = []
+                last_delivered = time.monotonic()
+
+        # The thumbnails are collected as soon as they are loaded, so a slow
+        # file does not hold back the files after it. The loaded thumbnails are
+        # delivered if no other thumbnail is loaded within the delivery
+        # interval.
+        for _ in range(len(self.files)):
+            while True:
+                if self.stopped.is_set():
+                    return
+                try:
+                    thumbnail = self.results.get(timeout=self.DELIVERY_INTERVAL)
+                    break
+                except queue.Empty:
+                    deliver()
+            batch.append(thumbnail)
 
-            pixmap = load_photo(file_name)
-            thumbnail = pixmap.scaled(self.width, self.width, Qt.KeepAspectRatio, Qt.SmoothTransformation)
-            QThread.msleep(100)
-            self.thumbnail_loaded.emit(grid_idx, list_idx, thumbnail)
+            if time.monotonic() - last_delivered >= self.DELIVERY_INTERVAL:
+                deliver()
 
-    def stop(self):
-        """Stop the thread by setting the stop flag."""
+        deliver()
 
-        self._stop_requested = True
-        # Block until thread has finished.
-        self.wait()
+    def stop(self, wait=True):
+        """Stop the thread by setting the stop flag. The thumbnails that are
+        not yet being decoded are skipped by the pool. If wait is True, block
+        until the thread has finished."""
 
+        self.stopped.set()
+        if wait:
+            self.wait()
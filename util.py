@@ -1,4 +1,4 @@
-import datetime, os, shutil, tempfile
+import datetime, os, tempfile, time
 from subprocess import Popen, PIPE
 
 import pytz
@@ -8,7 +8,8 @@ from PySide6.QtCore import Qt, QDateTime, QTimeZone
 from PySide6.QtGui import QImage, QPixmap
 from PySide6.QtWidgets import QCompleter
 
-from picture_metadata import load_exif_from_file
+from exceptions import TransformError
+from picture_metadata import read_exif_tags
 
 supported_extensions = ["cr2", "jpg", "jpeg", "png", "rw2"]
 
@@ -36,56 +37,165 @@ class DotDict(dict):
             value = DotDict(value)
         self[key] = value
     
-def list_files(path, extensions=None, recursive=False, hidden=False, followlinks=True):
+def list_files(path, extensions=None, recursive=False, hidden=False, followlinks=True, stat=False):
     """Get the files from the path that have the specified extension.
-    Optionally recursively and include hidden files and follow symlinks."""
+    Optionally recursively and include hidden files and follow symlinks. If
+    stat is True, the files are returned as tuples (path, size, modification
+    time in nanoseconds)."""
+
+    if recursive:
+        return list(walk_files(path, extensions=extensions, hidden=hidden, followlinks=followlinks, stat=stat))
 
     if extensions is None:
         extensions = ["." + e for e in supported_extensions]
-
+    # The extensions are compared as lowercase suffixes.
+    extensions = {e.lower() for e in extensions}
+
+    def is_listed(entry):
+        if not os.path.splitext(entry.name)[1].lower() in extensions: return False
+        # The file type is usually known from the directory listing, so this
+        # does not need a stat call.
+        return entry.is_file(follow_symlinks=followlinks)
+
+    def result(entry):
+        if not stat:
+            return entry.path
+        st = entry.stat(follow_symlinks=followlinks)
+        return entry.path, st.st_size, st.st_mtime_ns
+
+    # An OSError (for example PermissionError) is left to the caller.
     result_files = []
-    try:
-        if recursive:
-            for root, dirs, files in os.walk(path, followlinks=followlinks):
-                if not hidden:
-                    dirs[:] = [d for d in dirs if not d.startswith(".")]
-                    files = [f for f in files if not f.startswith(".")]
-                for entry in files:
-                    if not any(entry.lower().endswith(e) for e in extensions): continue
-                    full_path = os.path.join(root, entry)
-                    result_files.append(full_path)
-        else:
-            for entry in os.listdir(path):
-                if not any(entry.lower().endswith(e) for e in extensions): continue
-                full_path = os.path.join(path, entry)
-                if not os.path.isfile(full_path): continue
-                result_files.append(full_path)
-    except PermissionError:
-        # TODO: This should be handled.
-        raise
+    with os.scandir(path) as it:
+        for entry in it:
+            if not is_listed(entry): continue
+            result_files.append(result(entry))
 
     result_files.sort()
     return result_files
 
-def load_photo(file_name):
-    """Loads the pixel data from the given file and returns it as a QPixmap
-    object."""
+def walk_files(path, extensions=None, hidden=False, followlinks=True, stat=False, cancel=None, snapshot=None, directories=None):
+    """Generates the files from the path and its subdirectories that have the
+    specified extension. Optionally include hidden files and follow symlinks.
+    The files are generated in sorted order as the directories are read, so
+    the first files are available before the whole tree has been walked. If
+    stat is True, the files are generated as tuples (path, size, modification
+    time in nanoseconds). The walk stops if the given threading.Event cancel
+    is set. If a set directories is given, the directories reached by the
+    walk are added to it as they are reached.
+
+    If a snapshot dictionary is given, the directories whose modification
+    time has not changed since they were stored in the snapshot are not read
+    again. The snapshot maps directory paths to pairs (modification time in
+    nanoseconds, entries), where the entries are pairs (name, is directory),
+    and it is updated with the directories read during the walk. Once the walk
+    is complete, the directories under the path that were not reached (for
+    example because they have been removed) are deleted from the snapshot."""
+
+    if extensions is None:
+        extensions = ["." + e for e in supported_extensions]
+    extensions = {e.lower() for e in extensions}
+
+    visited = set()
+
+    def read(directory):
+        # Returns the names of the subdirectories and files of the directory
+        # or None if the directory cannot be read.
+        visited.add(directory)
+        if directories is not None:
+            directories.add(directory)
+        if snapshot is None:
+            mtime = None
+        else:
+            try:
+                mtime = os.stat(directory).st_mtime_ns
+            except OSError:
+                return None
+            if directory in snapshot and snapshot[directory][0] == mtime:
+                return snapshot[directory][1]
+
+        started = time.time_ns()
+        entries = []
+        try:
+            with os.scandir(directory) as it:
+                for entry in it:
+                    if entry.is_dir(follow_symlinks=followlinks):
+                        entries.append((entry.name, True))
+                    elif entry.is_file(follow_symlinks=followlinks):
+                        entries.append((entry.name, False))
+        except OSError:
+            return None
+
+        # A directory changed within the last second could change again
+        # without changing its modification time, so it is read again next
+        # time.
+        if mtime is not None and mtime < started - 1_000_000_000:
+            snapshot[directory] = (mtime, entries)
+
+        return entries
+
+    def scan(directory):
+        # Returns the subdirectories and the listed files of the directory
+        # sorted so that the walk generates the paths in sorted order. Like
+        # os.walk, we skip the directories that cannot be read.
+        result = []
+        for name, is_dir in read(directory) or []:
+            if not hidden and name.startswith("."): continue
+            if is_dir:
+                result.append((name + os.sep, True, os.path.join(directory, name)))
+            elif os.path.splitext(name)[1].lower() in extensions:
+                result.append((name, False, os.path.join(directory, name)))
+
+        result.sort(key=lambda x: x[0])
+        return iter(result)
+
+    stack = [scan(path)]
+    while len(stack) > 0:
+        if cancel is not None and cancel.is_set(): return
+
+        x = next(stack[-1], None)
+        if x is None:
+            stack.pop()
+            continue
+
+        _, is_dir, file_name = x
+        if is_dir:
+            stack.append(scan(file_name))
+        elif stat:
+            st = os.stat(file_name, follow_symlinks=followlinks)
+            yield file_name, st.st_size, st.st_mtime_ns
+        else:
+            yield file_name
+
+    if snapshot is not None:
+        prefix = os.path.join(path, "")
+        for directory in [d for d in snapshot if (d == path or d.startswith(prefix)) and d not in visited]:
+            del snapshot[directory]
+
+def load_image(file_name):
+    """Loads the pixel data from the given file and returns it as a QImage
+    object. Unlike QPixmap objects, QImage objects can be used outside the
+    thread of the UI."""
 
     extension = lambda x: x.split(".")[-1].lower() if "." in x else None
 
     match extension(file_name):
         case "cr2" | "rw2":
-            # Raw images.
+            # Raw images. The image is copied as it does not own the pixel data.
             raw = rawpy.imread(file_name)
             rgb = raw.postprocess(use_camera_wb=True)
             height, width, channels = rgb.shape
-            image = QImage(rgb, width, height, channels*width, QImage.Format_RGB888)
-            pixmap = QPixmap.fromImage(image)
+            image = QImage(rgb, width, height, channels*width, QImage.Format_RGB888).copy()
             raw.close()
         case _:
-            pixmap = QPixmap(file_name)
+            image = QImage(file_name)
+
+    return image
+
+def load_photo(file_name):
+    """Loads the pixel data from the given file and returns it as a QPixmap
+    object."""
 
-    return pixmap
+    return QPixmap.fromImage(load_image(file_name))
 
 def setup_separator_completer(lineEdit, word_list, separator=","):
     """Given a QLineEdit object lineEdit, set it up with with a
@@ -187,39 +297,24 @@ def qdatetime_to_datetime(qdt):
 
     return dt
 
-def rotate_image(file_name, angle):
-    """Rotate the image file by the given angle (multiple of 90 degrees)."""
-
-    # TODO: Handle errors.
-    # TODO: Only JPG images are supported.
-
-    if angle == 0: return
+def rotation_exif_tags(file_name, angle):
+    """Returns the EXIF tags (tag-value pairs) that need to be set when the
+    image file is rotated by the given angle (multiple of 90 degrees) with
+    transform_image."""
 
     if angle % 90 != 0:
         raise ValueError("Rotation only by multiples of 90 degrees is supported.")
 
     angle %= 360
+    if angle == 0: return {}
 
     extension = lambda x: x.split(".")[-1].lower() if "." in x else None
     match extension(file_name):
-        case "jpg" | "png":
-            # We actually rotate the image on disk and reset the EXIF orientation.
-            temp_file_name = tempfile.mktemp()
-
-            # Perform the actual rotation.
-            if extension(file_name) == "jpg":
-                # We use jpegtran for rotation.
-                Popen(["jpegtran", "-copy", "all", "-rotate", str(angle), "-outfile", temp_file_name, file_name], stdout=PIPE, stderr=PIPE).communicate()
-            else:
-                # We use ImageMagick for rotation.
-                Popen(["magick", file_name, "-rotate", str(angle), temp_file_name], stdout=PIPE, stderr=PIPE).communicate()
-
-            # Reset the EXIF orientation tag (if it exists).
-            exif = load_exif_from_file(temp_file_name, ["Exif.Image.Orientation"], ignore_errors=True)
-            if len(exif) > 0:
-                Popen(["exiv2", "-k", "-M", "set Exif.Image.Orientation 1", temp_file_name], stdout=PIPE, stderr=PIPE).communicate()
-
-            shutil.move(temp_file_name, file_name)
+        case "jpg" | "jpeg" | "png":
+            # The image is rotated on disk, so we reset the EXIF orientation
+            # tag (if it exists).
+            exif = read_exif_tags(file_name, ["Exif.Image.Orientation"])
+            return {"Exif.Image.Orientation": 1} if len(exif) > 0 else {}
         case "cr2" | "rw2":
             # We cannot rotate the image on disk, but we can adjust the EXIF
             # orientation. First we need to figure out the current orientation.
@@ -239,7 +334,7 @@ def rotate_image(file_name, angle):
                 7: 2,
             }
 
-            exif = load_exif_from_file(file_name, ["Exif.Image.Orientation"], ignore_errors=True)
+            exif = read_exif_tags(file_name, ["Exif.Image.Orientation"])
             if len(exif) > 0:
                 # The orientation tag exists.
                 current_orientation = int(exif["Exif.Image.Orientation"])
@@ -251,43 +346,86 @@ def rotate_image(file_name, angle):
             else:
                 # No orientation tag exists.
                 new_orientation = angle_map[angle]
-            
-            Popen(["exiv2", "-k", "-M", f"set Exif.Image.Orientation {new_orientation}", file_name], stdout=PIPE, stderr=PIPE).communicate()
+
+            return {"Exif.Image.Orientation": new_orientation}
         case _:
             raise ValueError(f"Unknown file type '{extension(file_name)}' for rotation.")
 
-def optimize_image(file_name):
-    """Optimize an image file for size. Remove embedded EXIF thumbnail data."""
+def transform_image(file_name, angle=0, optimize=False):
+    """Performs the pixel transformations of an image file in a single
+    lossless pass: rotation by the given angle (multiple of 90 degrees) and
+    optimization of the DFT coefficients of JPG files. The result is written
+    to a new temporary file in the same directory, and its name is returned.
+    If no pixel transformation is needed, the given file name is returned. The
+    EXIF tags given by rotation_exif_tags are not written. Raises
+    TransformError if the transformation fails."""
+
+    if angle % 90 != 0:
+        raise ValueError("Rotation only by multiples of 90 degrees is supported.")
+
+    angle %= 360
 
-    # TODO: Handle errors.
+    extension = lambda x: x.split(".")[-1].lower() if "." in x else None
+    match extension(file_name):
+        case "jpg" | "jpeg":
+            if angle == 0 and not optimize:
+                return file_name
+            # We use jpegtran for rotation and optimization.
+            call = ["jpegtran", "-copy", "all"]
+            if angle != 0:
+                call += ["-rotate", str(angle)]
+            if optimize:
+                call += ["-opt"] if angle != 0 else ["-opt", "-perfect"]
+        case "png":
+            if angle == 0:
+                return file_name
+            # We use ImageMagick for rotation.
+            call = ["magick", file_name, "-rotate", str(angle)]
+        case "cr2" | "rw2":
+            # We cannot rotate or optimize raw images on disk.
+            return file_name
+        case _:
+            if angle != 0:
+                raise ValueError(f"Unknown file type '{extension(file_name)}' for rotation.")
+            return file_name
 
-    temp_file_name = tempfile.mktemp()
+    # The temporary file is in the same directory, so that it can be moved
+    # over the original without copying.
+    fd, temp_file_name = tempfile.mkstemp(prefix=".arris-", suffix="." + extension(file_name), dir=os.path.dirname(os.path.abspath(file_name)))
+    os.close(fd)
 
-    # Optimize DFT coefficients for JPG.
-    extensions = ["jpg", "jpeg"]
-    if any(file_name.endswith("." + e) for e in extensions):
-        Popen(["jpegtran", "-opt", "-perfect", "-copy", "all", "-outfile", temp_file_name, file_name], stdout=PIPE, stderr=PIPE).communicate()
+    if call[0] == "jpegtran":
+        call += ["-outfile", temp_file_name, file_name]
     else:
-        shutil.copy(file_name, temp_file_name)
+        call.append(temp_file_name)
 
-    # Remove thumbnail.
-    Popen(["exiv2", "-dt", "rm", temp_file_name], stdout=PIPE, stderr=PIPE).communicate()
+    # A failed transformation must never replace the original, so the output
+    # is accepted only if the tool succeeded and wrote something.
+    try:
+        try:
+            process = Popen(call, stdout=PIPE, stderr=PIPE)
+        except OSError as exc:
+            raise TransformError(file_name, f"Cannot run {call[0]}: {exc}") from exc
+        _, stderr = process.communicate()
+        if process.returncode != 0:
+            raise TransformError(file_name, stderr.decode("utf-8", errors="replace").strip() or f"{call[0]} exited with code {process.returncode}.")
+        if os.path.getsize(temp_file_name) == 0:
+            raise TransformError(file_name, f"{call[0]} produced an empty file.")
+    except BaseException:
+        os.remove(temp_file_name)
+        raise
 
-    shutil.move(temp_file_name, file_name)
+    return temp_file_name
 
 def set_image_permissions(file_name):
     """Sets image permissions to 644."""
 
-    Popen(["chmod", "644", file_name], stdout=PIPE, stderr=PIPE).communicate()
+    os.chmod(file_name, 0o644)
 
 def set_image_timestamp(file_name, date_time):
     """Sets the image creation timestamp according to the given datetime
-    object."""
-
-    env = os.environ.copy()  # Make a copy of the current environment
-    env["TZ"] = "UTC"
+    object. The timestamp is set with a precision of one second."""
 
-    dt = date_time.astimezone(pytz.utc)
-    dt = f"{dt.year:04}-{dt.month:02}-{dt.day:02} {dt.hour:02}:{dt.minute:02}:{dt.second:02}"
-    Popen(["touch", "-d", dt, file_name], stdout=PIPE, stderr=PIPE, env=env).communicate()
+    timestamp = date_time.astimezone(pytz.utc).replace(microsecond=0).timestamp()
+    os.utime(file_name, (timestamp, timestamp))
 